@@ -0,0 +1,4 @@
+### __init__.py
+
+
+__version__ = "2.1.1"
@@ -0,0 +1,428 @@
+### benchmark.py
+#
+# Timings of Booky internals on synthetic data.
+#
+# $ python -m booky.benchmark
+# $ python -m booky.benchmark --pubdb-sizes 1000 1000000 --output new.json
+# $ python -m booky.benchmark --baseline benchmark-baseline.json
+#
+# A synthetic project (configure.toml, a pubdb and booklets) is written
+# to a temporary directory and the loaders, searches, booklet
+# augmentation, LaTeX output and table renderers are timed on it. Each
+# timing is the best of a few runs. Results go to a JSON file; given a
+# baseline (an earlier results file) the timings that got slower by more
+# than --threshold are listed and the exit status is 1.
+
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+import platform
+import tempfile
+import tracemalloc
+import booky
+import booky.config
+import booky.fragments
+import booky.messages
+import booky.model
+import booky.packing
+import booky.publication
+import booky.snapshot
+import booky.ticket
+
+
+SYNTHETIC_CONFIG = """\
+pub-db-filename = "pubs.toml"
+
+[pub-validation]
+colors = ["035", "070", "375", "488"]
+block-limits = [100, 300]
+cover-limits = [100, 300]
+
+[ticket-layout]
+left-margin = 2
+right-margin = 5
+upper-margin = 5
+lower-margin = 5
+font-size = 11
+vertical-stretch = 1.2
+title-width = 26
+title-styling = "\\\\large"
+label-width = 18
+volume-separation = 0
+ticket-spacing = 4
+cardboard-label = "carton"
+paper-label = "papier"
+buckram-label = "buckram"
+backcard-label = "carte-a-dos"
+"""
+
+TITLE_WORDS = ["Revue", "Bulletin", "Annales", "Studia", "Journal", "Cahiers",
+               "Theologique", "Biblique", "Historique", "Liturgie", "Monastique",
+               "Philosophie", "Archives", "Etudes", "Review", "Quarterly",
+               "Sciences", "Religieuses", "Patristique", "Medievale"]
+
+PUBDB_SIZES = [1000, 10000, 100000]
+BOOKLET_SIZES = [10, 1000, 10000]
+
+# Rendering a rich table is slow per row; bigger pubdbs are cut to this.
+RENDER_ROWS = 2000
+
+TICKETS_PER_PAGE = 5
+
+# The pubdb is also split into this many shards, see booky.pubshards.
+SHARDS = 8
+
+KEY_PATTERNS = ["pub12*", "*77*", "p?b5"]
+TITLE_PATTERNS = ["revue*", "*theo*", "*bulletin*quarterly*"]
+FUZZY_TERMS = ["revue theolgique", "bulettin", "quarterly review"]
+
+
+def synthetic_toml_pubdb(size, seed=0):
+    """A pubdb in the TOML layout, as tomllib would give it."""
+    rng = random.Random(seed)
+    pubdb_dict = {}
+    for n in range(size):
+        cover_height = rng.randint(110, 292)
+        cover_width = rng.randint(100, 220)
+        title = " ".join(rng.sample(TITLE_WORDS, rng.randint(2, 4)))
+        pubdb_dict[f"pub{n}"] = {'block-height': cover_height - 10,
+                                 'block-width': cover_width + 4,
+                                 'color': rng.choice(["035", "070", "375", "488"]),
+                                 'cover-height': cover_height,
+                                 'cover-width': cover_width,
+                                 'title': f"{title} {n}"}
+    return pubdb_dict
+
+
+def synthetic_pubdb(size, seed=0):
+    return {key: booky.model.publication_from_toml(entry)
+            for key, entry in sorted(synthetic_toml_pubdb(size, seed).items())}
+
+
+def synthetic_tickets(pubdb_dict, size, seed=0):
+    """size tickets of 1 to 8 volumes each."""
+    rng = random.Random(seed)
+    keys = list(pubdb_dict.keys())
+    return [booky.model.ticket_from_toml(
+                {'pub-key': rng.choice(keys),
+                 'volumes': [[f"{2000 + v}", rng.randint(15, 80)]
+                             for v in range(rng.randint(1, 8))]})
+            for n in range(size)]
+
+
+def write_booklet(booklet_filename, tickets):
+    """Write tickets as a booklet TOML file, TICKETS_PER_PAGE to a page."""
+    lines = []
+    for n, ticket in enumerate(tickets, 1):
+        volumes = ", ".join(f'["{v.volume_label}", {v.thickness}]' for v in ticket.volumes)
+        lines.append(f'[ticket.t{n}]\npub-key = "{ticket.pub_key}"\nvolumes = [{volumes}]\n\n')
+    names = [f'"t{n}"' for n in range(1, len(tickets) + 1)]
+    pages = [", ".join(names[i:i + TICKETS_PER_PAGE])
+             for i in range(0, len(names), TICKETS_PER_PAGE)]
+    lines.append('[booklet]\npages = [' + ",\n         ".join(f"[{p}]" for p in pages) + ']\n')
+    with open(booklet_filename, 'w') as f:
+        f.writelines(lines)
+
+
+def write_project(directory, pubdb_size, booklet_sizes, seed=0):
+    """A synthetic project in directory: configure.toml, pubs.toml and
+    booklet-N.toml for each N of booklet_sizes. Returns the pubdb_dict."""
+    with open(os.path.join(directory, 'configure.toml'), 'w') as f:
+        f.write(SYNTHETIC_CONFIG)
+    pubdb_dict = synthetic_pubdb(pubdb_size, seed)
+    with open(os.path.join(directory, 'pubs.toml'), 'w') as f:
+        booky.publication.dump_pubdb_toml(pubdb_dict, f)
+    for size in booklet_sizes:
+        write_booklet(os.path.join(directory, f'booklet-{size}.toml'),
+                      synthetic_tickets(pubdb_dict, size, seed))
+    return pubdb_dict
+
+
+def best_time(function, repeat=5, setup=None, budget=2.0):
+    """Best of repeat runs, in seconds. setup runs untimed before each
+    run. Slow functions get fewer runs: no new run starts once budget
+    seconds have gone by."""
+    best = None
+    spent = 0.0
+    for k in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        spent += elapsed
+        if spent > budget:
+            break
+    return best
+
+
+def remove_snapshots(filename):
+    for suffix in ['snap', 'idx']:
+        try:
+            os.remove(booky.snapshot.snapshot_filename(filename, suffix))
+        except OSError:
+            pass
+
+
+@contextlib.contextmanager
+def quiet_console():
+    """Send what the renderers print to a throwaway console."""
+    saved_options = dict(booky.messages.console_options)
+    booky.messages.console_options.update(file=io.StringIO(), width=120)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        booky.messages.console_options.clear()
+        booky.messages.console_options.update(saved_options)
+
+
+def bench_ticket_dimensions(pubdb_dict, tickets):
+    """One ticket at a time against the columnar batch computation."""
+    def per_ticket():
+        return [booky.ticket.compute_ticket_parameters(pubdb_dict, t) for t in tickets]
+
+    def columnar():
+        pub_keys = [t.pub_key for t in tickets for v in t.volumes]
+        thicknesses = [v.thickness for t in tickets for v in t.volumes]
+        return booky.ticket.compute_volume_columns(pubdb_dict, pub_keys, thicknesses)
+
+    return {'per-ticket': best_time(per_ticket), 'columnar': best_time(columnar)}
+
+
+def bench_ticket_latex(augmented_booklet):
+    """The LaTeX functions against the compiled templates, which must
+    write the same bytes."""
+    my_tickets = [t for page in augmented_booklet['pages'] for t in page]
+    layout = tuple([(field, augmented_booklet[field])
+                    for field in booky.fragments.LAYOUT_FIELDS])
+
+    def functions():
+        return ["".join(booky.ticket.latex_ticket_fragments(augmented_booklet, t))
+                for t in my_tickets]
+
+    def templates():
+        return [booky.ticket.latex_ticket(layout, t) for t in my_tickets]
+
+    if functions() != templates():
+        raise RuntimeError("ticket templates differ from latex_ticket_fragments")
+    return {'functions': best_time(functions), 'templates': best_time(templates)}
+
+
+def allocated_bytes(function):
+    """Memory still allocated by what function returns."""
+    tracemalloc.start()
+    try:
+        result = function()
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_pubdb_memory(size):
+    """Memory of a pubdb as TOML-layout dicts and as Publication."""
+    return {'toml-dicts': allocated_bytes(lambda: synthetic_toml_pubdb(size)),
+            'publications': allocated_bytes(lambda: synthetic_pubdb(size))}
+
+
+def bench_config(directory):
+    config_filename = os.path.join(directory, 'configure.toml')
+    load = lambda: booky.config.load_config(config_filename)
+    return {'load_config/cold': best_time(load, setup=lambda: remove_snapshots(config_filename)),
+            'load_config/snapshot': best_time(load)}
+
+
+def bench_shards(directory, pubdb_dict):
+    size = len(pubdb_dict)
+    shard_directory = os.path.join(directory, 'shards')
+    os.makedirs(shard_directory, exist_ok=True)
+    keys = list(pubdb_dict)
+    shard_filenames = []
+    for n in range(SHARDS):
+        shard_filename = os.path.join(shard_directory, f'shard-{n}.toml')
+        booky.publication.write_pubdb_toml(shard_filename,
+                                           {key: pubdb_dict[key] for key in keys[n::SHARDS]})
+        shard_filenames.append(shard_filename)
+
+    def remove_shard_snapshots():
+        for shard_filename in shard_filenames:
+            remove_snapshots(shard_filename)
+
+    load = lambda: booky.publication.load_pubdb(shard_directory)
+    booklet_keys = keys[::max(1, size // 12)][:12]
+    return {f'load_pubdb/sharded-cold/{size}': best_time(load, setup=remove_shard_snapshots),
+            f'load_pubdb/sharded-snapshot/{size}': best_time(load),
+            f'load_publications/sharded/{size}': best_time(
+                lambda: booky.publication.load_publications(shard_directory, booklet_keys))}
+
+
+def bench_pubdb(directory, size):
+    pubdb_filename = os.path.join(directory, 'pubs.toml')
+    load = lambda: booky.publication.load_pubdb(pubdb_filename)
+    results = {f'load_pubdb/cold/{size}':
+                   best_time(load, setup=lambda: remove_snapshots(pubdb_filename)),
+               f'load_pubdb/snapshot/{size}': best_time(load)}
+
+    pubdb_dict = load()
+    booklet_keys = list(pubdb_dict)[::max(1, size // 12)][:12]
+    results[f'load_publications/index/{size}'] = best_time(
+        lambda: booky.publication.load_publications(pubdb_filename, booklet_keys))
+    results.update(bench_shards(directory, pubdb_dict))
+    search_index = booky.publication.load_search_index(pubdb_filename, pubdb_dict)
+    search_keys = booky.publication.search_keys_pubdb
+    search_titles = booky.publication.search_titles_pubdb
+    results[f'search_keys_pubdb/{size}'] = best_time(
+        lambda: [search_keys(p, pubdb_dict, search_index) for p in KEY_PATTERNS])
+    results[f'search_titles_pubdb/{size}'] = best_time(
+        lambda: [search_titles(p, pubdb_dict, search_index) for p in TITLE_PATTERNS])
+    results[f'search_titles_pubdb/fuzzy/{size}'] = best_time(
+        lambda: [booky.publication.fuzzy_search_titles_pubdb(t, pubdb_dict, 10, search_index)
+                 for t in FUZZY_TERMS])
+    results[f'search_keys_pubdb/no-index/{size}'] = best_time(
+        lambda: [search_keys(p, pubdb_dict) for p in KEY_PATTERNS])
+    results[f'search_titles_pubdb/no-index/{size}'] = best_time(
+        lambda: [search_titles(p, pubdb_dict) for p in TITLE_PATTERNS])
+
+    shown = dict(list(pubdb_dict.items())[:RENDER_ROWS])
+    with quiet_console():
+        results[f'display_pubdb_narrow/{len(shown)}'] = best_time(
+            lambda: booky.publication.display_pubdb_narrow('Publications', shown), repeat=3)
+        results[f'display_pubdb_wide/{len(shown)}'] = best_time(
+            lambda: booky.publication.display_pubdb_wide('Publications', shown), repeat=3)
+    return results, pubdb_dict
+
+
+def bench_booklet(directory, config_dict, pubdb_dict, size):
+    booklet_filename = os.path.join(directory, f'booklet-{size}.toml')
+    tex_filename = os.path.join(directory, f'booklet-{size}.tex')
+    results = {f'load_booklet/{size}':
+                   best_time(lambda: booky.ticket.load_booklet(booklet_filename))}
+    booklet_dict = booky.ticket.load_booklet(booklet_filename)
+    augment = lambda: booky.ticket.augment_booklet(config_dict, pubdb_dict,
+                                                   booklet_dict, tex_filename)
+    results[f'augment_booklet/{size}'] = best_time(augment)
+    with quiet_console():
+        results[f'paginate/{size}'] = best_time(
+            lambda: booky.packing.paginate(config_dict, pubdb_dict, booklet_dict, force=True))
+    augmented_booklet = augment()
+    results[f'latex_write/{size}'] = best_time(
+        lambda: booky.ticket.latex_write(augmented_booklet))
+    t = bench_ticket_latex(augmented_booklet)
+    results[f'ticket_latex/functions/{size}'] = t['functions']
+    results[f'ticket_latex/templates/{size}'] = t['templates']
+    if size <= RENDER_ROWS:
+        with quiet_console():
+            results[f'preview_booklet/{size}'] = best_time(
+                lambda: booky.ticket.preview_booklet(booklet_filename, pubdb_dict,
+                                                     booklet_dict), repeat=3)
+    return results
+
+
+def run_suite(pubdb_sizes, booklet_sizes, report=print):
+    """All timings, as a dict of name: seconds."""
+    results = {}
+    for pubdb_size in pubdb_sizes:
+        with tempfile.TemporaryDirectory(prefix='booky-bench-') as directory:
+            report(f"pubdb of {pubdb_size} publications...")
+            write_project(directory, pubdb_size,
+                          booklet_sizes if pubdb_size == pubdb_sizes[0] else [])
+            pubdb_results, pubdb_dict = bench_pubdb(directory, pubdb_size)
+            results.update(pubdb_results)
+            if pubdb_size != pubdb_sizes[0]:
+                continue
+            results.update(bench_config(directory))
+            config_dict = booky.config.load_config(os.path.join(directory, 'configure.toml'))
+            for booklet_size in booklet_sizes:
+                report(f"booklet of {booklet_size} tickets...")
+                results.update(bench_booklet(directory, config_dict, pubdb_dict,
+                                             booklet_size))
+            for size in booklet_sizes:
+                tickets = synthetic_tickets(pubdb_dict, size)
+                t = bench_ticket_dimensions(pubdb_dict, tickets)
+                results[f'ticket_dimensions/per-ticket/{size}'] = t['per-ticket']
+                results[f'ticket_dimensions/columnar/{size}'] = t['columnar']
+    return results
+
+
+def compare(results, baseline, threshold, floor=0.001):
+    """(name, baseline seconds, seconds) of the timings more than
+    threshold (a fraction) slower than in baseline. Differences under
+    floor seconds are noise and never count."""
+    regressions = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if seconds > base * (1 + threshold) and seconds - base > floor:
+            regressions.append((name, base, seconds))
+    return regressions
+
+
+def environment():
+    return {'booky': booky.__version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'system': platform.system()}
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='python -m booky.benchmark',
+                                     description='Booky benchmarks on synthetic data.')
+    parser.add_argument('--pubdb-sizes', type=int, nargs='+', default=PUBDB_SIZES,
+                        metavar='N', help="Publication database sizes (the first "
+                        "one is used for the booklets).")
+    parser.add_argument('--booklet-sizes', type=int, nargs='+', default=BOOKLET_SIZES,
+                        metavar='N', help="Booklet sizes, in tickets.")
+    parser.add_argument('--output', default='booky-benchmark.json', metavar='FILE',
+                        help="Where to write the results (JSON).")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="Earlier results to compare against.")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="Slowdown that counts as a regression (default 0.25).")
+    parser.add_argument('--memory', action='store_true',
+                        help="Also measure pubdb memory (slow).")
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    results = run_suite(args.pubdb_sizes, args.booklet_sizes)
+    document = {'environment': environment(), 'results': results}
+    if args.memory:
+        size = args.pubdb_sizes[-1]
+        document['memory'] = {f'{name}/{size}': value
+                              for name, value in bench_pubdb_memory(size).items()}
+
+    width = max(len(name) for name in results)
+    for name, seconds in results.items():
+        print(f"{name:<{width}}  {seconds*1000:10.2f} ms")
+    for name, value in document.get('memory', {}).items():
+        print(f"{name:<{width}}  {value/2**20:10.1f} MiB")
+
+    with open(args.output, 'w') as f:
+        json.dump(document, f, indent=2)
+    print(f"\nResults written to {args.output}.")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.baseline}:")
+            for name, base, seconds in regressions:
+                print(f"  {name}: {base*1000:.2f} ms -> {seconds*1000:.2f} ms "
+                      f"({seconds/base - 1:+.0%})")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}.")
+
+
+if __name__ == '__main__':
+    main()
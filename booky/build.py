@@ -0,0 +1,485 @@
+### build.py
+
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import pathlib
+import platform
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+import booky
+import booky.messages
+import booky.packing
+import booky.ticket
+import booky.timing
+import booky.validation
+
+
+logger = logging.getLogger('booky')
+
+# Size of the buffer between us and pdflatex when streaming. Big enough
+# that a ticket or two go over in one write.
+PIPE_BUFFER_SIZE = 1 << 16
+
+# What a streamed pdflatex reads the document from: its standard input,
+# opened as a file.
+STREAM_INPUT = "/dev/stdin"
+
+# Built PDFs are kept here, named by the hash of their inputs.
+CACHE_DIRECTORY = ".booky-cache"
+
+# The least recently used PDFs are removed once the cache is bigger.
+BUILD_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# A sharded build gives every shard at least this many pages. Smaller
+# booklets are built as one document: below that, starting pdflatex
+# several times costs more than it saves.
+SHARD_MIN_PAGES = 10
+
+# Precompiled preambles (pdflatex formats) live here.
+FORMAT_DIRECTORY = os.path.join(CACHE_DIRECTORY, "formats")
+
+# Part of the name of a format. Raised when formats are made differently,
+# so that old ones (and old failures) are not used.
+FORMAT_VERSION = 2
+
+format_lock = threading.Lock()
+
+
+def pdflatex_command():
+    if platform.system() == 'Darwin':
+        return "/Library/TeX/texbin/pdflatex"
+    else:
+        return "pdflatex"
+
+
+@booky.timing.timed('pdflatex', 'external')
+def run_pdflatex(tex_filename, cwd=None, quiet=False, format_filename=None):
+    """Run pdflatex on a .tex file and return its exit status. Quiet runs
+    never stop to ask anything and keep their output in the .log file.
+    format_filename is a precompiled preamble, see precompiled_format."""
+    command = [pdflatex_command()]
+    if format_filename:
+        command.append(f'-fmt={format_filename}')
+    if quiet:
+        command += ['-interaction=nonstopmode', '-halt-on-error']
+    command.append(tex_filename)
+    output = subprocess.DEVNULL if quiet else None
+    try:
+        return subprocess.run(command, cwd=cwd, stdin=output, stdout=output).returncode
+    except FileNotFoundError:
+        if not quiet:
+            booky.messages.display_error(f"Can't run {command[0]}. Is LaTeX installed?")
+        return 127
+
+
+@booky.timing.timed('pdflatex (streamed)', 'external')
+def stream_pdflatex(augmented_booklet, jobname, cwd=None, quiet=False,
+                    format_filename=None):
+    """Pipe the LaTeX document straight into pdflatex, fragment by
+    fragment, without a .tex file. The output is jobname.pdf. Returns
+    the exit status of pdflatex.
+
+    pdflatex is told to \\input the pipe as a file (STREAM_INPUT), so
+    that it reads the whole document and still never stops to ask
+    anything. Typing the document in at its terminal instead would not
+    do: in nonstopmode TeX reads one line from the terminal and gives
+    up at the next, and in the other modes it prompts for every line.
+    Without /dev/stdin (Windows) it is read from the terminal in
+    scrollmode after all."""
+    command = [pdflatex_command(), '-halt-on-error', f'-jobname={jobname}']
+    if format_filename:
+        command.append(f'-fmt={format_filename}')
+    if os.path.exists(STREAM_INPUT):
+        command += ['-interaction=nonstopmode', f'\\input{{{STREAM_INPUT}}}']
+    else:
+        command.append('-interaction=scrollmode')
+    output = subprocess.DEVNULL if quiet else None
+    try:
+        process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE,
+                                   stdout=output, bufsize=PIPE_BUFFER_SIZE,
+                                   text=True, encoding='utf-8')
+    except FileNotFoundError:
+        if not quiet:
+            booky.messages.display_error(f"Can't run {command[0]}. Is LaTeX installed?")
+        return 127
+    try:
+        process.stdin.writelines(booky.ticket.latex_fragments(augmented_booklet))
+        process.stdin.close()
+    except BrokenPipeError:
+        # pdflatex stopped reading, most likely on an error. Its exit
+        # status says so. What is still buffered can't be written:
+        # close the pipe now rather than have it fail again when it is
+        # collected.
+        logger.info('pdflatex closed its input early.')
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    return process.wait()
+
+
+def number_of_shards(page_count, shards):
+    """How many shards to really use when asked for shards (0 meaning one
+    per CPU) for a booklet of page_count pages. 1 means don't shard."""
+    shards = shards or os.cpu_count()
+    return max(1, min(shards, page_count // SHARD_MIN_PAGES))
+
+
+def split_pages(pages, shard_count):
+    """Split the pages into shard_count runs of consecutive pages.
+    Returns a list of (first page number, pages)."""
+    size, extra = divmod(len(pages), shard_count)
+    result = []
+    start = 0
+    for k in range(shard_count):
+        end = start + size + (1 if k < extra else 0)
+        result.append((start + 1, pages[start:end]))
+        start = end
+    return result
+
+
+# Precompiled preamble.
+#
+# Loading memoir and multirow is most of the time of a small pdflatex
+# run. The preamble only depends on the ticket-layout, so it is dumped
+# once into a pdflatex format with the mylatexformat package and
+# documents are then compiled with -fmt. mylatexformat makes pdflatex
+# skip the preamble of the document itself, so the .tex is unchanged
+# and still compiles without the format. The format is named by a hash
+# of the preamble and of the pdflatex executable (formats don't survive
+# a TeX upgrade), so changing font-size or a margin makes a new one.
+
+
+def precompiled_format(augmented_booklet):
+    """Absolute name (without .fmt) of the precompiled format for the
+    preamble of augmented_booklet, dumping it first if need be. Returns
+    None if it can't be made, and then pdflatex just runs without it."""
+    executable = shutil.which(pdflatex_command())
+    if executable is None:
+        return None
+    preamble = booky.ticket.latex_preamble(augmented_booklet)
+    st = os.stat(executable)
+    key = hashlib.sha256(f"{FORMAT_VERSION}\n{executable}\n{st.st_mtime_ns}\n"
+                         f"{st.st_size}\n{preamble}"
+                         .encode('utf-8')).hexdigest()[:16]
+    name = os.path.abspath(os.path.join(FORMAT_DIRECTORY, f'booky-{key}'))
+
+    with format_lock:
+        if os.path.exists(name + '.fmt'):
+            return name
+        if os.path.exists(name + '.failed'):
+            return None
+        try:
+            os.makedirs(FORMAT_DIRECTORY, exist_ok=True)
+            dump_format(preamble, name)
+        except OSError as e:
+            logger.info(f'could not dump the preamble format: {e}')
+        if os.path.exists(name + '.fmt'):
+            logger.info(f'dumped preamble format {name}.fmt')
+            return name
+        booky.messages.display_warning(
+            "Could not precompile the LaTeX preamble (is the mylatexformat package "
+            "installed?), pdflatex runs without it. See "
+            f"{os.path.relpath(name)}.log; remove {os.path.relpath(name)}.failed "
+            "to try again.")
+        # Remember, so that we don't try again on every build.
+        try:
+            with open(name + '.failed', 'w') as f:
+                f.write(preamble)
+        except OSError as e:
+            logger.info(f'could not write {name}.failed: {e}')
+        return None
+
+
+@booky.timing.timed('dump preamble format', 'external')
+def dump_format(preamble, name):
+    """Dump preamble into name.fmt. mylatexformat dumps the format when it
+    gets to \\begin{document}, so the file has to go on that far. The
+    log of a run that fails is kept as name.log."""
+    work_directory = tempfile.mkdtemp(prefix='booky-format-')
+    try:
+        with open(os.path.join(work_directory, 'preamble.tex'), 'w') as f:
+            f.write(preamble + "\n\\begin{document}\n")
+        command = [pdflatex_command(), '-ini', '-interaction=nonstopmode',
+                   '-jobname=preamble', '&pdflatex', 'mylatexformat.ltx', 'preamble.tex']
+        status = subprocess.run(command, cwd=work_directory, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL).returncode
+        fmt_filename = os.path.join(work_directory, 'preamble.fmt')
+        if status == 0 and os.path.exists(fmt_filename):
+            os.replace(fmt_filename, name + '.fmt')
+        elif os.path.exists(os.path.join(work_directory, 'preamble.log')):
+            shutil.copyfile(os.path.join(work_directory, 'preamble.log'), name + '.log')
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+@booky.timing.timed('merge pdfs', 'external')
+def merge_pdfs(pdf_filenames, output_filename, work_directory):
+    """Concatenate PDFs in order. Uses qpdf or pdfunite if one of them is
+    installed, and otherwise pdflatex itself with the pdfpages package.
+    Returns an exit status."""
+    if shutil.which('qpdf'):
+        command = ['qpdf', '--empty', '--pages', *pdf_filenames, '--', output_filename]
+    elif shutil.which('pdfunite'):
+        command = ['pdfunite', *pdf_filenames, output_filename]
+    else:
+        merge_filename = os.path.join(work_directory, 'merge.tex')
+        with open(merge_filename, 'w') as f:
+            f.write("\\documentclass[a4paper]{article}\n"
+                    "\\usepackage{pdfpages}\n"
+                    "\\begin{document}\n")
+            for pdf_filename in pdf_filenames:
+                f.write(f"\\includepdf[pages=-]{{{os.path.basename(pdf_filename)}}}\n")
+            f.write("\\end{document}\n")
+        status = run_pdflatex('merge.tex', work_directory, quiet=True)
+        if status == 0:
+            shutil.move(os.path.join(work_directory, 'merge.pdf'), output_filename)
+        return status
+    return subprocess.run(command, stdin=subprocess.DEVNULL,
+                          stdout=subprocess.DEVNULL).returncode
+
+
+def sharded_pdflatex(augmented_booklet, jobname, shard_count, cwd=None,
+                     format_filename=None):
+    """Build jobname.pdf as shard_count documents of consecutive pages,
+    compiled at the same time and then merged. Pages are independent
+    (every page ends with \\newpage), so the result is the same as one
+    big run; page numbers carry on from shard to shard. Returns an exit
+    status. If a shard fails, its log becomes jobname.log."""
+    shard_directory = tempfile.mkdtemp(prefix=f'booky-{jobname}-shards-')
+
+    def compile_shard(k, first_page, pages):
+        shard = dict(augmented_booklet)
+        shard['pages'] = pages
+        with open(os.path.join(shard_directory, f'shard-{k}.tex'), 'w') as f:
+            f.writelines(booky.ticket.latex_fragments(shard, first_page))
+        return run_pdflatex(f'shard-{k}.tex', shard_directory, quiet=True,
+                            format_filename=format_filename)
+
+    try:
+        shards = split_pages(augmented_booklet['pages'], shard_count)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=shard_count) as pool:
+            statuses = list(pool.map(lambda a: compile_shard(*a),
+                                     [(k, *shard) for k, shard in enumerate(shards)]))
+        for k, status in enumerate(statuses):
+            if status != 0:
+                shutil.copyfile(os.path.join(shard_directory, f'shard-{k}.log'),
+                                os.path.join(cwd or '', jobname + '.log'))
+                return status
+        return merge_pdfs([os.path.join(shard_directory, f'shard-{k}.pdf')
+                           for k in range(shard_count)],
+                          os.path.join(cwd or '', jobname + '.pdf'),
+                          shard_directory)
+    except OSError as e:
+        logger.info(f'sharded build of {jobname} failed: {e}')
+        return 1
+    finally:
+        shutil.rmtree(shard_directory, ignore_errors=True)
+
+
+@booky.timing.timed('build booklet')
+def build_booklet(config_dict, pubdb_dict, booklet_filename,
+                  stream=False, force=False, isolated=False, shards=None,
+                  use_format=True, booklet_dict=None):
+    """Build the PDF of one booklet into the current directory and return
+    a summary: {'booklet', 'status', 'seconds', 'message'} with status
+    'built', 'cached' or 'failed'.
+
+    An isolated build runs pdflatex quietly in its own temporary
+    directory, so that several can run at once without their .aux and
+    .log files getting in each other's way. The .tex and .pdf are copied
+    back, and so is the .log if pdflatex failed.
+
+    With shards (0 meaning one per CPU) a big booklet is compiled in
+    pieces at the same time, see sharded_pdflatex. Unless use_format is
+    false, the preamble is precompiled, see precompiled_format.
+
+    booklet_dict is the booklet if it has already been loaded."""
+    start = time.perf_counter()
+    bd = booklet_dict or booky.ticket.load_booklet(booklet_filename)
+    booky.validation.exit_on_errors(
+        booky.validation.validate_references(booklet_filename, bd, pubdb_dict))
+    bd = booky.packing.paginate(config_dict, pubdb_dict, bd)
+    stem = pathlib.Path(booklet_filename).stem
+    key = build_key(config_dict, pubdb_dict, bd)
+    result = {'booklet': booklet_filename, 'status': 'cached', 'message': ''}
+
+    if force or not fetch_cached_pdf(key, stem + '.pdf'):
+        work_directory = tempfile.mkdtemp(prefix=f'booky-{stem}-') if isolated else None
+        ab = booky.ticket.augment_booklet(config_dict, pubdb_dict, bd,
+                                          os.path.join(work_directory or '', stem + '.tex'))
+        format_filename = precompiled_format(ab) if use_format else None
+        shard_count = number_of_shards(len(ab['pages']), shards) if shards is not None else 1
+        if shard_count > 1:
+            if not stream:
+                booky.ticket.latex_write(ab)
+            status = sharded_pdflatex(ab, stem, shard_count, work_directory,
+                                      format_filename)
+        elif stream:
+            status = stream_pdflatex(ab, stem, work_directory, isolated, format_filename)
+        else:
+            booky.ticket.latex_write(ab)
+            status = run_pdflatex(stem + '.tex', work_directory, isolated, format_filename)
+        if isolated:
+            copy_back = [stem + '.pdf'] if status == 0 else [stem + '.log']
+            if not stream:
+                copy_back.append(stem + '.tex')
+            for filename in copy_back:
+                try:
+                    shutil.copyfile(os.path.join(work_directory, filename), filename)
+                except OSError:
+                    pass
+            shutil.rmtree(work_directory, ignore_errors=True)
+        if status == 0:
+            result['status'] = 'built'
+            store_cached_pdf(key, stem + '.pdf')
+        else:
+            result['status'] = 'failed'
+            result['message'] = f"pdflatex exit status {status}"
+
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def build_booklets(config_dict, pubdb_dict, booklet_filenames,
+                   jobs=None, stream=False, force=False, shards=None, use_format=True,
+                   booklet_dicts=None):
+    """Build several booklets at once, at most jobs pdflatex runs at a
+    time. The jobs are threads: the work in Python is small next to
+    pdflatex, and threads share config_dict and pubdb_dict instead of
+    copying the database into every worker process.
+
+    booklet_dicts maps booklet filenames to the booklets already loaded,
+    with None for those that could not be, which are reported as failed."""
+    def job(booklet_filename):
+        start = time.perf_counter()
+        bd = booklet_dicts.get(booklet_filename) if booklet_dicts is not None else None
+        if booklet_dicts is not None and bd is None:
+            return {'booklet': booklet_filename, 'status': 'failed',
+                    'message': 'bad booklet file', 'seconds': 0.0}
+        try:
+            return build_booklet(config_dict, pubdb_dict, booklet_filename,
+                                 stream, force, isolated=True, shards=shards,
+                                 use_format=use_format, booklet_dict=bd)
+        except SystemExit:
+            # load_booklet or the reference check has already displayed
+            # what is wrong.
+            return {'booklet': booklet_filename, 'status': 'failed',
+                    'message': 'bad booklet file',
+                    'seconds': time.perf_counter() - start}
+        except Exception as e:
+            return {'booklet': booklet_filename, 'status': 'failed',
+                    'message': f"{type(e).__name__}: {e}",
+                    'seconds': time.perf_counter() - start}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        return list(pool.map(job, booklet_filenames))
+
+
+def display_build_summary(results, seconds):
+    import rich.table
+    status_style = {'built': 'green', 'cached': 'cyan', 'failed': 'bold red'}
+    table = rich.table.Table(title=f"Booklets ({seconds:.1f}s)")
+    table.add_column('Booklet', style='white')
+    table.add_column('Status')
+    table.add_column('Time', justify='right', style='white')
+    table.add_column('Note', style='white')
+    for r in results:
+        table.add_row(r['booklet'],
+                      f"[{status_style[r['status']]}]{r['status']}",
+                      f"{r['seconds']:.2f}s",
+                      r['message'])
+    console = booky.messages.make_console()
+    print()
+    console.print(table)
+    print()
+
+
+# Build cache.
+#
+# A booklet PDF depends on the booklet TOML, on the pubdb entries of the
+# publications it references, and on the ticket-layout configuration.
+# Hashing exactly those gives a key for the PDF: the rest of the
+# database can change without invalidating anything.
+
+
+def build_key(config_dict, pubdb_dict, booklet_dict):
+    pub_keys = sorted({t['pub-key'] for t in booklet_dict['ticket'].values()})
+    inputs = {'booky-version': booky.__version__,
+              'ticket-layout': config_dict['ticket-layout'],
+              'publications': {key: pubdb_dict.get(key) for key in pub_keys},
+              'booklet': booklet_dict}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def cache_filename(key):
+    return os.path.join(CACHE_DIRECTORY, key + '.pdf')
+
+
+def fetch_cached_pdf(key, pdf_filename):
+    """Copy the cached PDF for key to pdf_filename. Returns False on a miss."""
+    try:
+        shutil.copyfile(cache_filename(key), pdf_filename)
+    except OSError:
+        return False
+    # The mtime is what the eviction goes by: mark it as recently used.
+    try:
+        os.utime(cache_filename(key))
+    except FileNotFoundError:
+        # Evicted by another build in the meantime; the copy is good.
+        pass
+    return True
+
+
+def store_cached_pdf(key, pdf_filename, max_bytes=BUILD_CACHE_MAX_BYTES):
+    # Builds run in threads (-j) as well as processes: the temporary name
+    # is unique to both.
+    tmp_filename = f"{cache_filename(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        shutil.copyfile(pdf_filename, tmp_filename)
+        os.replace(tmp_filename, cache_filename(key))
+    except OSError as e:
+        logger.info(f'could not cache {pdf_filename}: {e}')
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        return
+    evict_cached_pdfs(max_bytes)
+
+
+def evict_cached_pdfs(max_bytes):
+    """Remove the least recently used PDFs until the cache fits in max_bytes.
+    Other builds may be storing and evicting at the same time: files that
+    are gone by the time they are looked at are skipped."""
+    entries = []
+    try:
+        with os.scandir(CACHE_DIRECTORY) as it:
+            for entry in it:
+                if entry.name.endswith('.pdf') and entry.is_file():
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+    except OSError as e:
+        logger.info(f'could not look through the build cache: {e}')
+        return
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            logger.info(f'evicted {path} from the build cache.')
+        except OSError:
+            pass
@@ -0,0 +1,689 @@
+### commands.py
+
+
+import argparse
+import logging
+
+import booky
+import booky.config
+import booky.duplicates
+import booky.messages
+import booky.publication
+import booky.snapshot
+import booky.timing
+import booky.validation
+
+# Startup matters here: --check-key and the searches are run many times
+# a day from the shop terminal. Keep the imports at the top cheap, and
+# import booky.ticket (tomllib, rich tables, LaTeX) and friends inside
+# the functions that need them. rich itself is only imported once
+# something is printed, see booky.messages.
+
+version = booky.__version__
+
+logger = logging.getLogger('booky')
+
+CONFIG_FILENAME = "configure.toml"
+
+# The daemon (booky.server) sets this to a dict so that config, pubdb and
+# search index stay in memory between requests. Entries are keyed by
+# filename and reloaded when the file signature changes.
+resident = None
+
+
+def keep_resident(name, filename, load, source_signature=booky.snapshot.source_signature):
+    if resident is None:
+        return load()
+    signature = source_signature(filename)
+    cached = resident.get((name, filename))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    value = load()
+    resident[(name, filename)] = (signature, value)
+    return value
+
+
+def get_config():
+    config_dict = keep_resident('config', CONFIG_FILENAME,
+                                lambda: booky.config.load_config(CONFIG_FILENAME))
+    return config_dict
+
+
+def uses_sqlite(config_dict):
+    return booky.publication.pubdb_backend(config_dict['pub-db-filename'],
+                                           config_dict.get('pub-db-backend')) == 'sqlite'
+
+
+def get_pubdb():
+    config_dict = get_config()
+    pubdb_filename = config_dict['pub-db-filename']
+    backend = config_dict.get('pub-db-backend')
+    pdb = keep_resident('pubdb', pubdb_filename,
+                        lambda: booky.publication.load_pubdb(pubdb_filename, backend),
+                        booky.publication.pubdb_signature)
+    return (config_dict, pdb)
+
+
+def get_publications(keys):
+    """(config_dict, pdb) where pdb has at least the publications of keys
+    that exist. Only those are read, except by the daemon, which keeps
+    the whole pubdb in memory anyway."""
+    config_dict = get_config()
+    if resident is not None and not uses_sqlite(config_dict):
+        return get_pubdb()
+    pdb = booky.publication.load_publications(config_dict['pub-db-filename'], keys,
+                                              config_dict.get('pub-db-backend'))
+    return (config_dict, pdb)
+
+
+def search_pubdb(field, search_arg, fuzzy_count=None):
+    """Search keys (field 'key') or titles (field 'title'). With a
+    fuzzy_count, the titles most like search_arg, that many of them."""
+    import booky.pubsqlite
+    config_dict = get_config()
+    if fuzzy_count is not None:
+        cd, pdb = get_pubdb()
+        return booky.publication.fuzzy_search_titles_pubdb(
+            search_arg, pdb, fuzzy_count, get_search_index(cd, pdb))
+    if uses_sqlite(config_dict):
+        search = {'key': booky.pubsqlite.search_keys,
+                  'title': booky.pubsqlite.search_titles}[field]
+        return search(config_dict['pub-db-filename'], search_arg)
+    cd, pdb = get_pubdb()
+    si = get_search_index(cd, pdb)
+    search = {'key': booky.publication.search_keys_pubdb,
+              'title': booky.publication.search_titles_pubdb}[field]
+    return search(search_arg, pdb, si)
+
+
+def get_search_index(config_dict, pdb):
+    pubdb_filename = config_dict['pub-db-filename']
+    return keep_resident('search-index', pubdb_filename,
+                         lambda: booky.publication.load_search_index(pubdb_filename, pdb),
+                         booky.publication.pubdb_signature)
+
+
+def show_pubdb(args, title, pdb, wide=True):
+    """A listing or search result: a rich table, or with --format rows
+    streamed for scripts. --offset and --limit pick a slice of either."""
+    if args.offset < 0 or (args.limit is not None and args.limit < 0):
+        booky.messages.display_error("--offset and --limit can't be negative.")
+        exit(1)
+    if not args.format:
+        display = (booky.publication.display_pubdb_wide if wide
+                   else booky.publication.display_pubdb_narrow)
+        display(title, pdb, args.offset, args.limit)
+        return
+    try:
+        booky.publication.write_pubdb(pdb, args.format, wide, args.offset, args.limit)
+    except BrokenPipeError:
+        # The reader went away (| head). Nothing left to say to it.
+        import os
+        import sys
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        exit(0)
+
+
+def do_find_duplicates(args):
+    cd, pdb = get_pubdb()
+    if not 0 < args.similarity <= 1:
+        booky.messages.display_error("--similarity should be more than 0 and at most 1.")
+        exit(1)
+    duplicate_groups = booky.duplicates.find_duplicates(pdb, args.similarity)
+    if args.format:
+        booky.duplicates.write_duplicates(duplicate_groups, pdb, args.format)
+    elif duplicate_groups:
+        booky.duplicates.display_duplicates(duplicate_groups, pdb)
+    else:
+        booky.messages.display_info("No duplicate titles or keys found.")
+
+
+def do_preview_booklet(booklet_filename):
+    import booky.packing
+    import booky.ticket
+    bd = booky.ticket.load_booklet(booklet_filename)
+    cd, pdb = get_publications(ticket.pub_key for ticket in bd['ticket'].values())
+    booky.validation.exit_on_errors(
+        booky.validation.validate_references(booklet_filename, bd, pdb))
+    bd = booky.packing.paginate(cd, pdb, bd)
+    booky.ticket.preview_booklet(booklet_filename, pdb, bd)
+
+
+def do_pack_booklet(booklet_filename):
+    """Show pages packing the tickets of a booklet, as a [booklet] table
+    to paste into it."""
+    import booky.packing
+    import booky.ticket
+    bd = booky.ticket.load_booklet(booklet_filename)
+    cd, pdb = get_publications(ticket.pub_key for ticket in bd['ticket'].values())
+    booky.validation.exit_on_errors(
+        booky.validation.validate_references(booklet_filename, bd, pdb))
+    pages = booky.packing.paginate(cd, pdb, bd, force=True)['booklet']['pages']
+    current = bd['booklet'].get('pages')
+    if current is not None:
+        booky.messages.display_info(f"{booklet_filename}: {len(bd['ticket'])} tickets "
+                                    f"on {len(current)} pages, they fit on {len(pages)}.")
+    rows = ",\n         ".join("[" + ", ".join(booky.publication.toml_string(t) for t in page) + "]"
+                               for page in pages)
+    print(f"[booklet]\npages = [{rows}]")
+
+
+def load_booklets(booklet_filenames):
+    """{filename: booklet} of booklet_filenames, loaded once each. With
+    several booklets one that can't be loaded is None (load_booklet has
+    displayed what is wrong), so that the others are still built."""
+    import booky.ticket
+    booklets = {}
+    for booklet_filename in booklet_filenames:
+        try:
+            booklets[booklet_filename] = booky.ticket.load_booklet(booklet_filename)
+        except SystemExit:
+            if len(booklet_filenames) == 1:
+                raise
+            booklets[booklet_filename] = None
+    return booklets
+
+
+def booklet_pub_keys(booklet_dicts):
+    """The keys of the publications on the loaded booklets."""
+    keys = set()
+    for bd in booklet_dicts:
+        if bd is not None:
+            keys.update(ticket.pub_key for ticket in bd['ticket'].values())
+    return keys
+
+
+def expand_booklet_filenames(patterns):
+    """Booklet filenames from the command line, with wildcards expanded
+    for shells that don't (or when they are quoted)."""
+    import glob
+    result = []
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]:
+            if filename not in result:
+                result.append(filename)
+    return result
+
+
+def do_make_booklet(booklet_patterns, stream=False, force=False, jobs=None, shards=None,
+                    use_format=True, fragment_store=True):
+    import booky.fragments
+    with booky.fragments.using_store(fragment_store):
+        make_booklets(booklet_patterns, stream, force, jobs, shards, use_format)
+
+
+def make_booklets(booklet_patterns, stream, force, jobs, shards, use_format):
+    import time
+    import booky.build
+    booklet_filenames = expand_booklet_filenames(booklet_patterns)
+    if not booklet_filenames:
+        booky.messages.display_error(f"No booklet matches {' '.join(booklet_patterns)}.")
+        exit(1)
+    booklet_dicts = load_booklets(booklet_filenames)
+    cd, pdb = get_publications(booklet_pub_keys(booklet_dicts.values()))
+
+    if len(booklet_filenames) == 1:
+        booklet_filename = booklet_filenames[0]
+        result = booky.build.build_booklet(cd, pdb, booklet_filename, stream, force,
+                                           shards=shards, use_format=use_format,
+                                           booklet_dict=booklet_dicts[booklet_filename])
+        if result['status'] == 'cached':
+            booky.messages.display_info(f"{booklet_filename}: the PDF is up to date "
+                                        "(from the build cache).\n"
+                                        "Use --force to build it again.")
+        elif result['status'] == 'failed':
+            booky.messages.display_error(f"pdflatex failed on {booklet_filename} "
+                                         f"({result['message']}).")
+            exit(1)
+        return
+
+    start = time.perf_counter()
+    results = booky.build.build_booklets(cd, pdb, booklet_filenames, jobs, stream, force,
+                                         shards, use_format, booklet_dicts)
+    booky.build.display_build_summary(results, time.perf_counter() - start)
+    if any(r['status'] == 'failed' for r in results):
+        exit(1)
+
+
+def do_watch(booklet_filename, use_format=True, fragment_store=True):
+    import booky.fragments
+    import booky.watch
+    with booky.fragments.using_store(fragment_store):
+        booky.watch.watch_booklet(booklet_filename, use_format)
+
+
+def do_validate(booklet_patterns):
+    """Check configure.toml, every publication against pub-validation and
+    the given booklets, and report all the problems together."""
+    import booky.journal
+    import booky.model
+    import booky.pubshards
+    errors = []
+    config_dict = booky.validation.read_toml(CONFIG_FILENAME, errors)
+    if config_dict is not None:
+        errors.extend(booky.validation.validate_config(CONFIG_FILENAME, config_dict))
+    if errors:
+        booky.validation.exit_on_errors(errors)
+
+    pubdb_filename = config_dict['pub-db-filename']
+    if uses_sqlite(config_dict):
+        pdb = booky.publication.load_pubdb(pubdb_filename, 'sqlite')
+    else:
+        pdb = {}
+        if booky.publication.is_sharded(pubdb_filename):
+            shard_filenames = booky.pubshards.shard_filenames(pubdb_filename)
+        else:
+            shard_filenames = [pubdb_filename]
+        shard_keys = []
+        for shard_filename in shard_filenames:
+            toml_dict = booky.validation.read_toml(shard_filename, errors) or {}
+            shard_keys.append((shard_filename, toml_dict.keys()))
+            for key in sorted(toml_dict):
+                entry = toml_dict[key]
+                if booky.validation.validate_publication_entry(key, entry, shard_filename,
+                                                               errors):
+                    pdb[key] = booky.model.publication_from_toml(entry)
+        if len(shard_filenames) > 1:
+            errors.extend(booky.pubshards.duplicate_errors(shard_keys))
+        else:
+            pdb = booky.journal.replay(pubdb_filename, pdb)
+        pdb = {key: pdb[key] for key in sorted(pdb)}
+    errors.extend(booky.validation.validate_publications(
+        pubdb_filename, pdb, booky.validation.pub_rules(config_dict)))
+
+    booklet_filenames = expand_booklet_filenames(booklet_patterns)
+    for booklet_filename in booklet_filenames:
+        booklet_dict = booky.validation.read_toml(booklet_filename, errors)
+        if booklet_dict is None:
+            continue
+        errors.extend(booky.validation.validate_booklet(booklet_filename, booklet_dict))
+        errors.extend(booky.validation.validate_references(booklet_filename, booklet_dict, pdb))
+
+    booky.validation.exit_on_errors(errors)
+    booky.messages.display_info(f"{CONFIG_FILENAME}, {len(pdb)} publications and "
+                                f"{len(booklet_filenames)} booklet(s) are ok.")
+
+
+def do_pubdb_import(toml_filename):
+    import booky.pubsqlite
+    config_dict = get_config()
+    pubdb_filename = config_dict['pub-db-filename']
+    if not uses_sqlite(config_dict):
+        booky.messages.display_error(f"{pubdb_filename} is not an SQLite database.\n"
+                                     "Set pub-db-filename in configure.toml to a .sqlite "
+                                     "file to import into it.")
+        exit(1)
+    signature, hash_value, pdb = booky.publication.parse_pubdb(toml_filename)
+    booky.pubsqlite.write_pubdb(pubdb_filename, pdb)
+    booky.messages.display_info(f"{len(pdb)} publications imported from {toml_filename} "
+                                f"into {pubdb_filename}.")
+
+
+def do_pubdb_export(toml_filename):
+    import os.path
+    cd, pdb = get_pubdb()
+    if os.path.abspath(toml_filename) == os.path.abspath(cd['pub-db-filename']):
+        booky.messages.display_error(f"Will not export {toml_filename} onto itself.")
+        exit(1)
+    booky.publication.write_pubdb_toml(toml_filename, pdb)
+    booky.messages.display_info(f"{len(pdb)} publications exported to {toml_filename}.")
+
+
+def journal_pubdb():
+    """(config_dict, pubdb filename) of a pubdb that can take journal edits."""
+    config_dict = get_config()
+    pubdb_filename = config_dict['pub-db-filename']
+    if uses_sqlite(config_dict) or booky.publication.is_sharded(pubdb_filename):
+        booky.messages.display_error(f"{pubdb_filename} is not a TOML file. Publications "
+                                     "can only be added, updated and deleted in a "
+                                     "single TOML pubdb.")
+        exit(1)
+    return (config_dict, pubdb_filename)
+
+
+def do_edit_pub(op, arguments):
+    """--add-pub, --update-pub and --delete-pub: arguments is the key
+    followed by FIELD=VALUE assignments."""
+    import booky.journal
+    config_dict, pubdb_filename = journal_pubdb()
+    key, assignments = arguments[0], arguments[1:]
+    fields, errors = booky.journal.parse_fields(assignments)
+    if op == 'delete' and assignments:
+        errors.append("--delete-pub takes only a key.")
+    if op == 'update' and not assignments and not errors:
+        errors.append("--update-pub needs at least one FIELD=VALUE.")
+    booky.validation.exit_on_errors(errors)
+    booky.journal.edit(pubdb_filename, config_dict, op, key, fields)
+    done = {'add': 'added', 'update': 'updated', 'delete': 'deleted'}[op]
+    booky.messages.display_info(f"Publication {key} {done}.")
+
+
+def do_compact():
+    import booky.journal
+    pubdb_filename = journal_pubdb()[1]
+    records, written = booky.journal.compact(pubdb_filename)
+    if records == 0:
+        booky.messages.display_info(f"{pubdb_filename} has no journal to compact.")
+        return
+    booky.messages.display_info(f"{records} journal records folded into {pubdb_filename}, "
+                                f"{written} publications written.")
+
+
+def do_import(import_filename):
+    import booky.pubimport
+    config_dict, pubdb_filename = journal_pubdb()
+    count, errors = booky.pubimport.import_publications(import_filename, pubdb_filename,
+                                                        config_dict)
+    if errors:
+        booky.validation.display_errors(errors)
+    booky.messages.display_info(f"{count} publications imported from {import_filename}, "
+                                f"{len(errors)} problems.\nRun --compact to write them "
+                                f"into {pubdb_filename}.")
+    if errors:
+        exit(1)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+            description='Booky command-line tool.',
+            epilog='Choose an option.')
+
+    group = parser.add_mutually_exclusive_group()
+    
+    group.add_argument('-g', '--config',
+                       help="Show Booky configuration parameters.",
+                       action="store_true")
+
+    group.add_argument('-l', '--list',
+                       help="List keys and titles in the database.",
+                       action="store_true")
+
+    group.add_argument('-L', '--list-full',
+                       help="List full publication entries.",
+                       action="store_true")
+    
+    group.add_argument('-c', '--check-key',
+                       help="Checks if given key is available (unique).",
+                       action='store',
+                       metavar='')
+
+    group.add_argument('-s', '--search-keys',
+                       help=("Search of publication keys." 
+                             "If you use a wildcard like *, "
+                             "enclose the search term in quotes."),
+                       action='store',
+                       metavar='')
+
+    group.add_argument('-S', '--search-titles',
+                       help=("Search of publication titles. "
+                             "If you use a wildcard like * in your search term, "
+                             "enclose the term in quotes."),
+                       action='store',
+                       metavar='')
+
+    group.add_argument('--find-duplicates',
+                       help=("List groups of publications whose titles are nearly "
+                             "the same, or whose keys differ only in case."),
+                       action='store_true')
+
+    group.add_argument('-b', '--preview-booklet',
+                       help=("Preview booklet onto terminal display."),
+                       action='store',
+                       metavar='')
+
+    group.add_argument('-B', '--make-booklet',
+                       help=("Make tex booklet and build pdf. Several booklets "
+                             "(or a quoted wildcard like \"booklet-*.toml\") "
+                             "are built in parallel."),
+                       action='store',
+                       nargs='+',
+                       metavar='')
+
+    group.add_argument('--pack-booklet',
+                       help=("Pack the tickets of a booklet onto as few pages "
+                             "as they fit and show the pages."),
+                       action='store',
+                       metavar='BOOKLET')
+
+    group.add_argument('--watch',
+                       help=("Rebuild a booklet whenever it, the configuration "
+                             "or the publication database changes."),
+                       action='store',
+                       metavar='BOOKLET')
+
+    group.add_argument('--validate',
+                       help=("Check the configuration, every publication and "
+                             "the given booklets, and report all problems."),
+                       action='store',
+                       nargs='*',
+                       metavar='BOOKLET')
+
+    group.add_argument('--pubdb-import',
+                       help=("Replace the SQLite publication database with "
+                             "the publications of a TOML file."),
+                       action='store',
+                       metavar='TOML')
+
+    group.add_argument('--pubdb-export',
+                       help="Write the publication database to a TOML file.",
+                       action='store',
+                       metavar='TOML')
+
+    group.add_argument('--add-pub',
+                       help=("Add a publication, for example: --add-pub etu "
+                             "title=Etudes color=320 block-height=229 ... "
+                             "Recorded in the journal, see --compact."),
+                       action='store',
+                       nargs='+',
+                       metavar=('KEY', 'FIELD=VALUE'))
+
+    group.add_argument('--update-pub',
+                       help="Change fields of a publication: --update-pub etu color=320",
+                       action='store',
+                       nargs='+',
+                       metavar=('KEY', 'FIELD=VALUE'))
+
+    group.add_argument('--delete-pub',
+                       help="Delete a publication.",
+                       action='store',
+                       nargs=1,
+                       metavar='KEY')
+
+    group.add_argument('--import',
+                       help=("Add the publications of a CSV, TSV or JSONL file "
+                             "with a header row of field names. Rows with "
+                             "problems are listed and left out."),
+                       action='store',
+                       dest='import_filename',
+                       metavar='FILE')
+
+    group.add_argument('--compact',
+                       help=("Fold the journal of publication edits into "
+                             "the publication database."),
+                       action='store_true')
+
+    group.add_argument('--serve',
+                       help=("Run the Booky daemon in this directory. "
+                             "Other Booky commands started here will use it."),
+                       action='store_true')
+
+    parser.add_argument('--format',
+                        help=("With --list, --list-full and the searches, write "
+                              "plain rows for scripts instead of a table."),
+                        action='store',
+                        choices=booky.publication.OUTPUT_FORMATS)
+
+    parser.add_argument('--fuzzy',
+                        help=("With --search-titles, list the titles most like the "
+                              f"term, best first ({booky.publication.FUZZY_RESULTS} "
+                              "of them unless --limit is given), instead of "
+                              "wildcard matches."),
+                        action='store_true')
+
+    parser.add_argument('--similarity',
+                        help=("With --find-duplicates, how alike two titles must "
+                              "be, from 0 to 1 (default "
+                              "%(default)s)."),
+                        action='store',
+                        type=float,
+                        default=booky.duplicates.DUPLICATE_SIMILARITY,
+                        metavar='S')
+
+    parser.add_argument('--offset',
+                        help=("With --list, --list-full and the searches, skip "
+                              "the first N rows."),
+                        action='store',
+                        type=int,
+                        default=0,
+                        metavar='N')
+
+    parser.add_argument('--limit',
+                        help=("With --list, --list-full and the searches, show "
+                              "at most N rows."),
+                        action='store',
+                        type=int,
+                        metavar='N')
+
+    parser.add_argument('--stream',
+                        help=("With --make-booklet, pipe the LaTeX straight "
+                              "into pdflatex instead of writing a .tex file."),
+                        action='store_true')
+
+    parser.add_argument('-j', '--jobs',
+                        help=("With --make-booklet, the most pdflatex runs at once. "
+                              "Default: the number of CPUs."),
+                        action='store',
+                        type=int,
+                        metavar='N')
+
+    parser.add_argument('--shards',
+                        help=("With --make-booklet, compile big booklets as N "
+                              "pieces at once and merge them (0: one per CPU)."),
+                        action='store',
+                        type=int,
+                        metavar='N')
+
+    parser.add_argument('--no-format',
+                        help=("With --make-booklet, don't use a precompiled "
+                              "LaTeX preamble."),
+                        action='store_true')
+
+    parser.add_argument('--no-fragment-cache',
+                        help=("With --make-booklet and --watch, don't keep the "
+                              "LaTeX of tickets on disk for later builds."),
+                        action='store_true')
+
+    parser.add_argument('--force',
+                        help=("With --make-booklet, build even if the build "
+                              "cache has an up to date PDF."),
+                        action='store_true')
+
+    parser.add_argument('--profile',
+                        help=("Time the phases of the command, show a summary and "
+                              "write a Chrome trace (default booky-profile.json)."),
+                        action='store',
+                        nargs='?',
+                        const='booky-profile.json',
+                        metavar='TRACE')
+
+    parser.add_argument('--no-daemon',
+                        help="Do not use a running Booky daemon.",
+                        action='store_true')
+
+    return parser
+
+
+def run(parser, args):
+    """Run the command chosen by args. Used by both the command line
+    and the daemon."""
+    if not args.profile:
+        run_command(parser, args)
+        return
+    booky.timing.enable()
+    try:
+        with booky.timing.span('command'):
+            run_command(parser, args)
+    finally:
+        booky.timing.write_chrome_trace(args.profile)
+        booky.timing.display_summary(args.profile)
+        booky.timing.disable()
+
+
+def run_command(parser, args):
+    if args.config:
+        config_dict = get_config()
+        booky.config.display_config(CONFIG_FILENAME, config_dict)
+    
+    elif args.list:
+        config_dict, pdb = get_pubdb()
+        show_pubdb(args, 'Publications', pdb, wide=False)
+
+    elif args.list_full:
+        cd, pdb = get_pubdb()
+        show_pubdb(args, 'Publications (full)', pdb)
+
+    elif args.search_keys:
+        result = search_pubdb('key', args.search_keys)
+        show_pubdb(args, "Search keys result", result)
+
+    elif args.search_titles and args.fuzzy:
+        count = args.offset + (booky.publication.FUZZY_RESULTS if args.limit is None
+                               else args.limit)
+        result = search_pubdb('title', args.search_titles, count)
+        show_pubdb(args, "Closest titles", result)
+
+    elif args.search_titles:
+        result = search_pubdb('title', args.search_titles)
+        show_pubdb(args, "Search titles result", result)
+
+    elif args.find_duplicates:
+        do_find_duplicates(args)
+        
+    elif args.check_key:
+        cd, pdb = get_publications([args.check_key])
+        if args.check_key in pdb.keys():
+            booky.messages.display_warning((f"Key {args.check_key} already exists in pub database:\n" 
+                                            f"{args.check_key}... {pdb[args.check_key].title}"))
+        else:
+            booky.messages.display_info(f"Key {args.check_key} is ok!\n"
+                          "No publication uses this key!")
+
+    elif args.preview_booklet:
+        do_preview_booklet(args.preview_booklet)
+
+    elif args.make_booklet:
+        do_make_booklet(args.make_booklet, args.stream, args.force, args.jobs,
+                        args.shards, not args.no_format, not args.no_fragment_cache)
+
+    elif args.pack_booklet:
+        do_pack_booklet(args.pack_booklet)
+
+    elif args.watch:
+        do_watch(args.watch, not args.no_format, not args.no_fragment_cache)
+
+    elif args.validate is not None:
+        do_validate(args.validate)
+
+    elif args.pubdb_import:
+        do_pubdb_import(args.pubdb_import)
+
+    elif args.pubdb_export:
+        do_pubdb_export(args.pubdb_export)
+
+    elif args.add_pub:
+        do_edit_pub('add', args.add_pub)
+
+    elif args.update_pub:
+        do_edit_pub('update', args.update_pub)
+
+    elif args.delete_pub:
+        do_edit_pub('delete', args.delete_pub)
+
+    elif args.import_filename:
+        do_import(args.import_filename)
+
+    elif args.compact:
+        do_compact()
+                             
+    else:
+        parser.print_help()
@@ -0,0 +1,274 @@
+### duplicates.py
+#
+# Near-duplicate titles and keys.
+#
+# The same serial sent twice under slightly different titles ("Etudes
+# d'Histoire", "Etudes d'Histroire") ends up under two keys. Titles are
+# compared after case folding and with punctuation taken out, and two are
+# near duplicates if their edit distance is at most 1 - similarity of the
+# longer one's length.
+#
+# Comparing every pair would take hours on 100k publications, so pairs
+# are found through trigrams. d edits change at most 3d of the trigrams
+# of a title, so a title within d edits of x has one of any 3d + 1
+# trigrams of x. Taking for every title its 3d + 1 rarest trigrams (in
+# one order for all titles), two titles that are near duplicates share
+# one of them, so only titles posted under those are candidates. They
+# must also share enough trigrams and have a close enough length before
+# the edit distance, which gives up as soon as it is over d, is worked
+# out.
+#
+# Pairs are joined into groups, so three spellings of one title are
+# reported together.
+
+
+import re
+import bisect
+import logging
+import collections
+import booky.messages
+import booky.publication
+import booky.timing
+
+logger = logging.getLogger('booky')
+
+NGRAM = booky.publication.NGRAM
+
+DUPLICATE_SIMILARITY = 0.85
+
+
+def normalize(s):
+    """s case folded, with runs of punctuation and spaces made one space."""
+    return re.sub(r'[\W_]+', ' ', booky.publication.fold(s)).strip()
+
+
+def trigrams(s):
+    return {s[i:i+NGRAM] for i in range(len(s) - NGRAM + 1)}
+
+
+def pattern_masks(a):
+    """{character: bit mask of its positions in a}."""
+    masks = {}
+    for i, c in enumerate(a):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    return masks
+
+
+# Both distances are Myers' bit-parallel algorithm (in Hyyro's form for
+# Levenshtein distance): a column of the edit distance table is kept as
+# the bits of its vertical +1 and -1 steps, so each character of b costs
+# a few operations on integers as long as a, and not a loop over a.
+
+def edit_distance(a, b, limit):
+    """The Levenshtein distance of a and b, or limit + 1 if it is more
+    than limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    if not a:
+        return len(b)
+    return bounded_distance(pattern_masks(a), len(a), b, limit)
+
+
+def bounded_distance(masks, m, b, limit):
+    """edit_distance of b and the string of length m > 0 with pattern_masks
+    masks."""
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    remaining = len(b)
+    for c in b:
+        eq = masks.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        remaining -= 1
+        if score - remaining > limit:
+            return limit + 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return min(score, limit + 1)
+
+
+def substring_distance(query, s):
+    """The least edit distance between query and any part of s."""
+    if not query:
+        return 0
+    masks = pattern_masks(query)
+    mask = (1 << len(query)) - 1
+    high = 1 << (len(query) - 1)
+    pv, mv, score = mask, 0, len(query)
+    best = score
+    for c in s:
+        eq = masks.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        best = min(best, score)
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return best
+
+
+def similarity(a, b):
+    """1 for equal strings, down to 0."""
+    longest = max(len(a), len(b))
+    if longest == 0:
+        return 1.0
+    return 1 - edit_distance(a, b, longest) / longest
+
+
+def max_distance(length, min_similarity):
+    return int((1 - min_similarity) * length + 1e-9)
+
+
+@booky.timing.timed('near duplicates')
+def near_duplicates(strings, min_similarity=DUPLICATE_SIMILARITY):
+    """Pairs (i, j), i < j, of the positions of strings that are the
+    same or within the edit distance min_similarity allows."""
+    distinct = {}
+    for position, s in enumerate(strings):
+        distinct.setdefault(s, []).append(position)
+    pairs = [(positions[0], other)
+             for positions in distinct.values() for other in positions[1:]]
+    if min_similarity >= 1:
+        return pairs
+    # Shortest first, so that a string is only compared with shorter
+    # ones, and those too short for it are at the start of every list.
+    values = sorted(distinct, key=len)
+    lengths = [len(s) for s in values]
+    gram_sets = [trigrams(s) for s in values]
+    frequency = collections.Counter()
+    for grams in gram_sets:
+        frequency.update(grams)
+    # Rarest first.
+    rank = {gram: n for n, gram in enumerate(sorted(frequency,
+                                                    key=lambda g: (frequency[g], g)))}
+
+    posted = {}
+    skipped = {}
+    short = []
+    compared = 0
+    for x, s in enumerate(values):
+        gx = gram_sets[x]
+        d = max_distance(len(s), min_similarity)
+        shortest = len(s) - d
+        grams = sorted(gx, key=rank.__getitem__)
+        # Lose 3d trigrams and one of the rest is still there.
+        probe = NGRAM * d + 1
+        if len(grams) < probe:
+            # Too short for its trigrams to say anything.
+            candidates = range(bisect.bisect_left(lengths, shortest), x)
+        else:
+            candidates = {y for y in short if lengths[y] >= shortest}
+            for gram in grams[:probe]:
+                ys = posted.get(gram)
+                if ys:
+                    n = skipped.get(gram, 0)
+                    while n < len(ys) and lengths[ys[n]] < shortest:
+                        n += 1
+                    skipped[gram] = n
+                    candidates.update(ys[n:])
+        masks = pattern_masks(s) if s else None
+        for y in candidates:
+            if len(gx & gram_sets[y]) < len(gx) - NGRAM * d:
+                continue
+            compared += 1
+            t = values[y]
+            distance = bounded_distance(masks, len(s), t, d) if s else len(t)
+            if distance <= d:
+                pairs.append(tuple(sorted((distinct[values[y]][0], distinct[s][0]))))
+        # Longer strings may be further away: post enough trigrams for them.
+        post = NGRAM * max_distance(len(s) / min_similarity, min_similarity) + 1
+        if len(grams) < post:
+            short.append(x)
+        else:
+            for gram in grams[:post]:
+                posted.setdefault(gram, []).append(x)
+    logger.info(f'{len(values)} distinct strings, {compared} edit distances.')
+    return pairs
+
+
+def groups(pairs):
+    """The connected groups of pairs, as sorted lists, in order of their
+    first position."""
+    parent = {}
+
+    def find(i):
+        while parent.setdefault(i, i) != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    members = {}
+    for i in parent:
+        members.setdefault(find(i), []).append(i)
+    return sorted(sorted(group) for group in members.values())
+
+
+def find_duplicates(pubdb_dict, min_similarity=DUPLICATE_SIMILARITY):
+    """Groups of keys of pubdb_dict whose titles are near duplicates, or
+    whose keys differ only in case and punctuation, each group a list of
+    keys in key order. Keys are short codes, where one letter more or
+    less is usually another publication, so they are not matched by
+    edit distance."""
+    keys = list(pubdb_dict)
+    pairs = near_duplicates([normalize(pubdb_dict[key].title) for key in keys],
+                            min_similarity)
+    pairs.extend(near_duplicates([normalize(key) for key in keys], 1))
+    return [[keys[i] for i in group] for group in groups(pairs)]
+
+
+def display_duplicates(duplicate_groups, pubdb_dict):
+    import rich.table
+    table = rich.table.Table(title='Possible duplicates')
+    table.add_column('Group', justify='right', style='white')
+    table.add_column('Key', justify='right', style='bold magenta')
+    table.add_column('Title', style='white')
+    for n, group in enumerate(duplicate_groups, 1):
+        for key in group:
+            table.add_row(str(n) if key == group[0] else '', key, pubdb_dict[key].title)
+        table.add_section()
+    console = booky.messages.make_console()
+    print()
+    console.print(table)
+    print()
+
+
+def write_duplicates(duplicate_groups, pubdb_dict, output_format, f=None):
+    """Write the groups to f (standard output) as rows of group number,
+    key and title, in output_format."""
+    import sys
+    import json
+    f = f or sys.stdout
+    rows = [(n, key, pubdb_dict[key].title)
+            for n, group in enumerate(duplicate_groups, 1) for key in group]
+    if output_format == 'tsv':
+        f.write("group\tkey\ttitle\n")
+        f.writelines(f"{n}\t{booky.publication.tsv_field(key)}\t"
+                     f"{booky.publication.tsv_field(title)}\n" for n, key, title in rows)
+    else:
+        objects = [json.dumps({'group': n, 'key': key, 'title': title}, ensure_ascii=False)
+                   for n, key, title in rows]
+        if output_format == 'jsonl':
+            f.writelines(line + "\n" for line in objects)
+        else:
+            f.write("[\n" + ",\n".join(objects) + "\n]\n" if objects else "[]\n")
+    f.flush()
@@ -0,0 +1,149 @@
+### fragments.py
+#
+# Cache of the LaTeX of tickets.
+#
+# The table of a ticket depends only on its title, colour and volume
+# dimensions, and on the nine ticket-layout values in LAYOUT_FIELDS. The
+# same tickets come back all the time, within a booklet (catbq twice in
+# booklet-test-2) and from one booklet to the next, so their LaTeX is
+# kept and a repeat ticket is emitted by one lookup instead of the
+# eleven LaTeX functions:
+#
+#  - in memory, in an LRU of MEMORY_ENTRIES tickets;
+#  - optionally on disk, in a marshalled dict (.booky-cache/fragments)
+#    that open_store loads and save_store writes back, so that the next
+#    build starts with the tickets of this one. Only the tickets the
+#    build used are written back, at most STORE_ENTRIES, so the store
+#    stays the size of the booklets being worked on and is quick to load.
+#
+# Keys are plain tuples, (layout values, title, colour, volumes), and a
+# TicketDimensions key hashes and compares equal to the same plain tuple,
+# so no digest has to be computed for a lookup.
+
+
+import os
+import marshal
+import functools
+import contextlib
+import threading
+import booky
+import booky.ticket
+import booky.model
+
+
+LAYOUT_FIELDS = ['label-width', 'volume-separation', 'vertical-stretch',
+                 'title-width', 'title-styling',
+                 'cardboard-label', 'paper-label', 'buckram-label', 'backcard-label']
+
+MEMORY_ENTRIES = 4096
+
+STORE_FILENAME = os.path.join(".booky-cache", "fragments")
+
+# The most tickets the store keeps, the most recently used.
+STORE_ENTRIES = 4096
+
+# The disk store, a dict from key to LaTeX, or None when not in use.
+# Its order is least recently used first.
+store = None
+store_changed = False
+# The keys looked up since open_store.
+store_used = set()
+store_lock = threading.Lock()
+
+
+def layout_values(augmented_booklet):
+    return tuple([augmented_booklet[field] for field in LAYOUT_FIELDS])
+
+
+@functools.lru_cache(maxsize=MEMORY_ENTRIES)
+def render(layout, title, color, volumes):
+    """The LaTeX of one ticket, as latex_ticket_fragments writes it."""
+    my_ticket = booky.model.TicketDimensions('', title, color, volumes)
+    return booky.ticket.latex_ticket(tuple(zip(LAYOUT_FIELDS, layout)), my_ticket)
+
+
+def ticket_latex(layout, my_ticket):
+    """The LaTeX of my_ticket (a TicketDimensions) under the layout values
+    given by layout_values."""
+    global store_changed
+    key = (layout, my_ticket.title, my_ticket.color, my_ticket.volumes)
+    if store is None:
+        return render(*key)
+    latex = store.pop(key, None)
+    if latex is None:
+        latex = render(*key)
+        store_changed = True
+    # (Re)inserted last: the most recently used.
+    store[key] = latex
+    store_used.add(key)
+    return latex
+
+
+def ticket_latex_function(augmented_booklet):
+    """ticket_latex for the layout of augmented_booklet, in the form
+    booky.ticket.latex_fragments takes."""
+    layout = layout_values(augmented_booklet)
+    return lambda my_ticket: ticket_latex(layout, my_ticket)
+
+
+def plain_key(key):
+    layout, title, color, volumes = key
+    return (layout, title, color, tuple([tuple(vol) for vol in volumes]))
+
+
+def open_store():
+    """Start using the disk store, loading what earlier builds left."""
+    global store, store_changed
+    with store_lock:
+        if store is not None:
+            return
+        try:
+            with open(STORE_FILENAME, 'rb') as f:
+                saved = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            saved = None
+        # The LaTeX functions may change from one version to the next.
+        if not isinstance(saved, dict) or saved.get('version') != booky.__version__:
+            saved = {'fragments': {}}
+        store = saved['fragments']
+        store_changed = False
+        store_used.clear()
+
+
+def save_store():
+    """Write the disk store back, if it changed, keeping the tickets used
+    since open_store, at most STORE_ENTRIES."""
+    global store_changed
+    with store_lock:
+        # Nothing built (every PDF came from the build cache, say): the
+        # store is left as it is.
+        if store is None or not store_used:
+            return
+        if not store_changed and len(store_used) == len(store):
+            return
+        items = [(key, latex) for key, latex in store.items()
+                 if key in store_used][-STORE_ENTRIES:]
+        payload = {'version': booky.__version__,
+                   'fragments': {plain_key(key): latex for key, latex in items}}
+        tmp_filename = f"{STORE_FILENAME}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(STORE_FILENAME), exist_ok=True)
+            with open(tmp_filename, 'wb') as f:
+                marshal.dump(payload, f)
+            os.replace(tmp_filename, STORE_FILENAME)
+            store_changed = False
+        except OSError:
+            pass
+
+
+@contextlib.contextmanager
+def using_store(enabled=True):
+    """Use the disk store for the duration of the block."""
+    if not enabled:
+        yield
+        return
+    open_store()
+    try:
+        yield
+    finally:
+        save_store()
@@ -0,0 +1,242 @@
+### journal.py
+#
+# Journal of publication edits.
+#
+# --add-pub, --update-pub and --delete-pub don't rewrite pubs.toml: each
+# appends one line to pubs.toml.journal, a JSON record such as
+#
+#   {"op": "update", "key": "etu", "fields": {"color": "320"}}
+#
+# The loaders replay the journal over what they read from pubs.toml (or
+# its snapshot), so an edit is seen at once and costs the same whether
+# the database has a hundred publications or a hundred thousand.
+# --import adds a whole file of publications to the journal at once (see
+# pubimport.py). --compact folds the journal into pubs.toml, written out
+# sorted, and removes it.
+#
+# Edits and compaction hold an exclusive lock on .pubs.toml.lock while
+# they check and write, so editors working at the same time can't add
+# the same key twice or lose a record to a compaction. Readers don't
+# lock: a record is appended in one write, a torn last line is skipped,
+# and replaying a record twice changes nothing, which covers a reader
+# that comes between the two steps of a compaction.
+
+
+import os
+import json
+import logging
+import contextlib
+import booky.messages
+import booky.model
+import booky.snapshot
+import booky.validation
+
+logger = logging.getLogger('booky')
+
+OPERATIONS = ('add', 'update', 'delete')
+
+
+def journal_filename(pubdb_filename):
+    return pubdb_filename + '.journal'
+
+
+def journal_signature(pubdb_filename):
+    """Signature of the journal, or None if there is none."""
+    try:
+        return booky.snapshot.source_signature(journal_filename(pubdb_filename))
+    except OSError:
+        return None
+
+
+@contextlib.contextmanager
+def locked(pubdb_filename):
+    """Hold the edit lock of pubdb_filename for the duration of the block."""
+    try:
+        import fcntl
+    except ImportError:
+        # No flock here (Windows): editors have to take turns.
+        yield
+        return
+    with open(booky.snapshot.snapshot_filename(pubdb_filename, 'lock'), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def read_records(pubdb_filename):
+    """The records of the journal, oldest first."""
+    try:
+        with open(journal_filename(pubdb_filename), 'rb') as f:
+            lines = f.read().split(b'\n')
+    except FileNotFoundError:
+        return []
+    records = []
+    for n, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # The last line may be half written by an editor right now.
+            logger.info(f'journal line {n} skipped.')
+            continue
+        records.append(record)
+    return records
+
+
+def apply_records(pubdb_dict, records, keys=None):
+    """pubdb_dict with records applied, in key order. Only the records
+    of keys are applied if keys is given; pubdb_dict must then hold
+    those of keys that exist before the journal."""
+    result = dict(pubdb_dict)
+    for record in records:
+        key = record['key']
+        if keys is not None and key not in keys:
+            continue
+        if record['op'] == 'add':
+            result[key] = booky.model.publication_from_toml(record['fields'])
+        elif record['op'] == 'update':
+            if key in result:
+                fields = result[key].as_dict()
+                fields.update(record['fields'])
+                result[key] = booky.model.publication_from_toml(fields)
+        elif record['op'] == 'delete':
+            result.pop(key, None)
+    return {key: result[key] for key in sorted(result)}
+
+
+def replay(pubdb_filename, pubdb_dict, keys=None):
+    """pubdb_dict brought up to date with the journal, if there is one."""
+    if journal_signature(pubdb_filename) is None:
+        return pubdb_dict
+    records = read_records(pubdb_filename)
+    logger.info(f'{len(records)} journal records replayed.')
+    return apply_records(pubdb_dict, records, keys)
+
+
+def append_record(pubdb_filename, record):
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    fd = os.open(journal_filename(pubdb_filename), os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def append_records(pubdb_filename, records):
+    """Append the records, an iterable, to the journal in one atomic
+    pass: they are written after a copy of the journal, which the copy
+    then replaces. Returns the number of records appended. The edit lock
+    must be held."""
+    import shutil
+    filename = journal_filename(pubdb_filename)
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    count = 0
+    try:
+        with open(tmp_filename, 'wb') as f:
+            try:
+                with open(filename, 'rb') as old:
+                    shutil.copyfileobj(old, f)
+            except FileNotFoundError:
+                pass
+            for record in records:
+                f.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        if count:
+            os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    return count
+
+
+def parse_fields(assignments):
+    """{field: value} from FIELD=VALUE strings, with the values of the
+    integer fields converted. Returns (fields, errors)."""
+    types = booky.validation.PUBLICATION['types']
+    fields = {}
+    errors = []
+    for assignment in assignments:
+        field, equals, value = assignment.partition('=')
+        field = field.strip()
+        if not equals:
+            errors.append(f"{assignment!r} should be FIELD=VALUE.")
+        elif field not in types:
+            errors.append(f"unknown field {field}, should be one of "
+                          f"{', '.join(sorted(types))}.")
+        elif types[field] is int:
+            try:
+                fields[field] = int(value)
+            except ValueError:
+                errors.append(f"{field} value {value!r} should be an integer.")
+        else:
+            fields[field] = value
+    return fields, errors
+
+
+def current_keys(pubdb_filename):
+    """The set of keys of pubdb_filename with the journal applied, from
+    the offset index when there is one."""
+    import booky.pubshards
+    keys = set(booky.pubshards.shard_keys(pubdb_filename))
+    for record in read_records(pubdb_filename):
+        if record['op'] == 'add':
+            keys.add(record['key'])
+        elif record['op'] == 'delete':
+            keys.discard(record['key'])
+    return keys
+
+
+def current_publication(pubdb_filename, key):
+    """The publication of key with the journal applied, or None."""
+    import booky.publication
+    pubdb_dict = booky.publication.load_publications(pubdb_filename, [key], 'toml')
+    return pubdb_dict.get(key)
+
+
+def edit(pubdb_filename, config_dict, op, key, fields=None):
+    """Check an add, update or delete of publication key and record it in
+    the journal. Problems are shown and end the command."""
+    where = journal_filename(pubdb_filename)
+    with locked(pubdb_filename):
+        pub = current_publication(pubdb_filename, key)
+        if op == 'add' and pub is not None:
+            booky.messages.display_error(f"Key {key} already exists in pub database.")
+            exit(1)
+        if op in ('update', 'delete') and pub is None:
+            booky.messages.display_error(f"No publication with key {key}.")
+            exit(1)
+
+        record = {'op': op, 'key': key}
+        if op != 'delete':
+            entry = pub.as_dict() if pub is not None else {}
+            entry.update(fields)
+            errors = []
+            if booky.validation.validate_publication_entry(key, entry, where, errors):
+                errors.extend(booky.validation.validate_publications(
+                    where, {key: booky.model.publication_from_toml(entry)},
+                    booky.validation.pub_rules(config_dict)))
+            booky.validation.exit_on_errors(errors)
+            record['fields'] = entry if op == 'add' else fields
+        append_record(pubdb_filename, record)
+
+
+def compact(pubdb_filename):
+    """Fold the journal into pubdb_filename. Returns the number of
+    records folded in and of publications written."""
+    import booky.publication
+    with locked(pubdb_filename):
+        records = read_records(pubdb_filename)
+        if not records:
+            return (0, None)
+        pubdb_dict = apply_records(booky.publication.load_pubdb_toml(pubdb_filename),
+                                   records)
+        booky.publication.write_pubdb_toml(pubdb_filename, pubdb_dict)
+        os.remove(journal_filename(pubdb_filename))
+    return (len(records), len(pubdb_dict))
@@ -1,38 +1,49 @@
 ### messages.py
 
 
-from rich import print as rprint
-from rich.panel import Panel
-from rich.table import Table
-from rich.console import Console
+# rich is imported inside the functions: it is the most expensive import
+# in Booky, and the cheap commands should not pay for it until they
+# actually print something.
+
+# Extra keyword arguments for every rich Console that Booky makes. The
+# daemon uses this to render for the client's terminal.
+console_options = {}
+
+
+def make_console():
+    import rich.console
+    return rich.console.Console(**console_options)
 
 
 def display_welcome(version):
-    rprint(f"[white bold]Booky version {version}.")
+    make_console().print(f"[white bold]Booky version {version}.")
            
 
 def display_error(message):
-    rprint(Panel(f"[white]{message}",
-                 style='red',
-                 title='ERROR',
-                 subtitle='ERROR',
-                 expand=False))
+    from rich.panel import Panel
+    make_console().print(Panel(f"[white]{message}",
+                               style='red',
+                               title='ERROR',
+                               subtitle='ERROR',
+                               expand=False))
 
 
 def display_warning(message):
-    rprint(Panel(f"[white]{message}",
-                 style='yellow',
-                 title='warning',
-                 subtitle='',
-                 expand=False))
+    from rich.panel import Panel
+    make_console().print(Panel(f"[white]{message}",
+                               style='yellow',
+                               title='warning',
+                               subtitle='',
+                               expand=False))
 
 
 def display_info(message):
-    rprint(Panel(f"[white]{message}",
-                 style='green',
-                 title='',
-                 subtitle='',
-                 expand=False))
+    from rich.panel import Panel
+    make_console().print(Panel(f"[white]{message}",
+                               style='green',
+                               title='',
+                               subtitle='',
+                               expand=False))
 
 
 def display_toml_error(filename):
@@ -0,0 +1,134 @@
+### model.py
+#
+# Compact types for publications, tickets and volumes.
+#
+# Publications, booklet tickets and the computed ticket dimensions used
+# to be plain dicts, each repeating its string keys ('cover-height', ...)
+# and paying for a hash table. These are named tuples instead: fixed
+# fields, no per-instance __dict__ (__slots__ = ()), immutable, and a
+# fraction of the memory. Named tuples rather than frozen dataclasses
+# because they are several times faster to make, which matters when a
+# 100k-entry database is loaded on every command.
+#
+# Each type can still be read with the TOML field names, pub['cover-height']
+# being pub.cover_height, so code and files written against the TOML
+# layout keep working. Repeated short strings (keys, colours, volume
+# labels) are interned.
+
+
+import sys
+import typing
+
+
+def toml_item(self, name):
+    """pub['cover-height'] is pub.cover_height; integers index as usual."""
+    if isinstance(name, str):
+        try:
+            return getattr(self, name.replace('-', '_'))
+        except AttributeError:
+            raise KeyError(name) from None
+    return tuple.__getitem__(self, name)
+
+
+def toml_dict(self):
+    """Back to the TOML layout: a dict with hyphenated field names."""
+    return {field.replace('_', '-'): to_toml(value)
+            for field, value in zip(self._fields, self)}
+
+
+def to_toml(value):
+    if isinstance(value, tuple) and hasattr(value, 'as_dict'):
+        return value.as_dict()
+    if isinstance(value, tuple):
+        return [to_toml(v) for v in value]
+    return value
+
+
+class Publication(typing.NamedTuple):
+    """A pubdb entry. The key is not part of it: it is the pubdb_dict key."""
+    title: str
+    color: str
+    block_height: int
+    block_width: int
+    cover_height: int
+    cover_width: int
+
+    __getitem__ = toml_item
+    as_dict = toml_dict
+
+
+class Volume(typing.NamedTuple):
+    """A volume of a ticket as written in a booklet: ["2023-1", 45]."""
+    volume_label: str
+    thickness: int
+
+    __getitem__ = toml_item
+    as_dict = toml_dict
+
+
+class Ticket(typing.NamedTuple):
+    """A [ticket.*] table of a booklet."""
+    pub_key: str
+    volumes: tuple
+
+    __getitem__ = toml_item
+    as_dict = toml_dict
+
+
+class VolumeDimensions(typing.NamedTuple):
+    """The computed binding components of one volume."""
+    volume_label: str
+    cardboard_height: int
+    cardboard_width: int
+    paper_height: int
+    paper_width: int
+    buckram_height: int
+    buckram_width: int
+    backcard_height: int
+    backcard_width: int
+
+    __getitem__ = toml_item
+    as_dict = toml_dict
+
+
+class TicketDimensions(typing.NamedTuple):
+    """A ticket ready to typeset: publication data and the dimensions
+    of its volumes."""
+    pub_key: str
+    title: str
+    color: str
+    volumes: tuple
+
+    __getitem__ = toml_item
+    as_dict = toml_dict
+
+
+PUBLICATION_TOML_FIELDS = [field.replace('_', '-') for field in Publication._fields]
+
+
+def publication_from_toml(entry):
+    """Publication from a pubdb TOML table. Raises KeyError for a missing
+    field and ValueError for an unexpected one."""
+    extra = set(entry) - set(PUBLICATION_TOML_FIELDS)
+    if extra:
+        raise ValueError(f"unexpected field {sorted(extra)[0]}")
+    return Publication(entry['title'],
+                       sys.intern(entry['color']),
+                       entry['block-height'],
+                       entry['block-width'],
+                       entry['cover-height'],
+                       entry['cover-width'])
+
+
+def ticket_from_toml(entry):
+    """Ticket from a [ticket.*] table of a booklet."""
+    return Ticket(sys.intern(entry['pub-key']),
+                  tuple(Volume(sys.intern(vol[0]), vol[1]) for vol in entry['volumes']))
+
+
+def booklet_from_toml(booklet_dict):
+    """The booklet TOML with its tickets converted to Ticket."""
+    result = dict(booklet_dict)
+    result['ticket'] = {name: ticket_from_toml(entry)
+                        for name, entry in booklet_dict['ticket'].items()}
+    return result
@@ -0,0 +1,188 @@
+### packing.py
+#
+# Automatic pages for booklets.
+#
+# A booklet whose [booklet] table has no pages gets them here: the
+# tickets are packed onto as few A4 pages as will hold them. The height
+# of a ticket is estimated from the ticket-layout the way LaTeX sets the
+# table: six rows of vertical-stretch times the baselineskip of the font
+# size, the rules, and the ticket-spacing that follows each ticket. The
+# title is typeset in a title-width column over the six rows, so a long
+# title that wraps onto more lines than that makes the ticket taller.
+# Widths are estimated too, from the number of volumes, to warn about
+# tickets that will run into the right margin.
+#
+# Packing is best fit decreasing: the tallest tickets first, each onto
+# the page it fills the most. The free heights of the pages are kept
+# sorted, so each ticket costs one bisection and thousands of tickets
+# are packed at once. The tickets of a page keep their order in the
+# booklet, and the pages are in the order of their first ticket.
+
+
+import bisect
+import logging
+import re
+import booky.messages
+import booky.ticket
+
+logger = logging.getLogger('booky')
+
+
+# a4paper, in mm.
+PAPER_HEIGHT = 297
+PAPER_WIDTH = 210
+
+MM_PER_PT = 25.4 / 72.27
+
+# \baselineskip of the memoir class options, in pt.
+BASELINESKIP = {9: 11, 10: 12, 11: 13.6, 12: 14.5, 14: 17}
+
+# Font sizes relative to \normalsize.
+SIZE_COMMANDS = {'tiny': 0.5, 'scriptsize': 0.7, 'footnotesize': 0.8, 'small': 0.9,
+                 'normalsize': 1.0, 'large': 1.2, 'Large': 1.44, 'LARGE': 1.73,
+                 'huge': 2.07, 'Huge': 2.49}
+
+# Average width of a character of the sans serif font, in em.
+CHARACTER_WIDTH = 0.5
+
+TABCOLSEP = 6           # pt, on each side of every column.
+ARRAYRULEWIDTH = 0.4    # pt
+TABLE_ROWS = 6
+TABLE_RULES = 7         # \hline, five \cline rows, \hline.
+LINESKIP = 1            # pt, between a table and what follows it.
+PARINDENT = 1.5         # em
+
+# Room left at the bottom of every page for what the estimates miss, in mm.
+PAGE_SLACK = 5
+
+
+def title_scale(title_styling):
+    """The size of the title relative to the body font, from the size
+    command in title-styling, if any."""
+    match = re.search(r"\\(" + "|".join(SIZE_COMMANDS) + r")(?![a-zA-Z])", title_styling)
+    return SIZE_COMMANDS[match.group(1)] if match else 1.0
+
+
+def wrapped_lines(text, line_characters):
+    """The number of lines text takes, broken between words, at
+    line_characters characters per line."""
+    lines = 1
+    used = 0
+    for word in text.split():
+        if used and used + 1 + len(word) > line_characters:
+            lines += 1
+            used = 0
+        used += len(word) + (1 if used else 0)
+    return lines
+
+
+def baselineskip_mm(layout):
+    font_size = layout['font-size']
+    return BASELINESKIP.get(font_size, 1.2 * font_size) * MM_PER_PT
+
+
+def ticket_height(layout, title):
+    """Estimated height of a ticket on the page in mm, including the
+    ticket-spacing after it."""
+    baselineskip = baselineskip_mm(layout)
+    table = TABLE_ROWS * layout['vertical-stretch'] * baselineskip \
+        + TABLE_RULES * ARRAYRULEWIDTH * MM_PER_PT
+    scale = title_scale(layout['title-styling'])
+    em = layout['font-size'] * scale * MM_PER_PT
+    line_characters = max(1, int(layout['title-width'] / (CHARACTER_WIDTH * em)))
+    title_lines = wrapped_lines(title, line_characters)
+    return max(table, title_lines * scale * baselineskip) \
+        + LINESKIP * MM_PER_PT + layout['ticket-spacing']
+
+
+def ticket_width(layout, my_ticket):
+    """Estimated width of a ticket (a TicketDimensions) in mm."""
+    em = layout['font-size'] * MM_PER_PT
+    column = 2 * TABCOLSEP * MM_PER_PT
+    width = PARINDENT * em + layout['title-width'] + layout['label-width'] + 2 * column
+    for volume_label, *dimensions in my_ticket.volumes:
+        digits = max([len(str(d)) for d in dimensions])
+        width += max(2 * (digits * CHARACTER_WIDTH * em + column),
+                     len(str(volume_label)) * CHARACTER_WIDTH * em + column)
+    width += (len(my_ticket.volumes) - 1) * (layout['volume-separation'] + column)
+    columns = 2 + 3 * len(my_ticket.volumes)
+    return width + (columns + 1) * ARRAYRULEWIDTH * MM_PER_PT
+
+
+def page_height(layout):
+    """The height available for tickets on a page in mm."""
+    return PAPER_HEIGHT - layout['upper-margin'] - layout['lower-margin'] - PAGE_SLACK
+
+
+def page_width(layout):
+    return PAPER_WIDTH - layout['left-margin'] - layout['right-margin']
+
+
+def pack(heights, capacity):
+    """Pack items of the given heights into as few bins of capacity as
+    best fit decreasing manages. Returns the bins as lists of item
+    indices, in the order of their first item, each in increasing
+    order. An item taller than capacity gets a bin of its own."""
+    order = sorted(range(len(heights)), key=lambda i: heights[i], reverse=True)
+    bins = []
+    # (free height, bin number), sorted.
+    free = []
+    for i in order:
+        height = heights[i]
+        k = bisect.bisect_left(free, (height, -1))
+        if k < len(free):
+            room, b = free.pop(k)
+        else:
+            room, b = capacity, len(bins)
+            bins.append([])
+        bins[b].append(i)
+        bisect.insort(free, (room - height, b))
+    for items in bins:
+        items.sort()
+    bins.sort(key=lambda items: items[0])
+    return bins
+
+
+def pack_tickets(layout, my_tickets):
+    """Pages for my_tickets, a dict from ticket names to their
+    TicketDimensions (or anything with a title and volumes), as lists
+    of ticket names."""
+    names = list(my_tickets)
+    title_heights = {}
+    heights = []
+    for name in names:
+        title = my_tickets[name].title
+        height = title_heights.get(title)
+        if height is None:
+            height = title_heights[title] = ticket_height(layout, title)
+        heights.append(height)
+    pages = pack(heights, page_height(layout))
+    return [[names[i] for i in page] for page in pages]
+
+
+def overwide_tickets(layout, my_tickets):
+    """Names of the tickets estimated to be wider than the page."""
+    width = page_width(layout)
+    return [name for name, my_ticket in my_tickets.items()
+            if ticket_width(layout, my_ticket) > width]
+
+
+def paginate(config_dict, pubdb_dict, booklet_dict, force=False):
+    """booklet_dict (as load_booklet makes it) with its pages packed
+    automatically if it has none, or if force is true."""
+    if 'pages' in booklet_dict['booklet'] and not force:
+        return booklet_dict
+    layout = config_dict['ticket-layout']
+    my_tickets = {name: booky.ticket.compute_ticket_parameters(pubdb_dict, ticket)
+                  for name, ticket in booklet_dict['ticket'].items()}
+    overwide = overwide_tickets(layout, my_tickets)
+    if overwide:
+        shown = ", ".join(overwide[:10]) + (", ..." if len(overwide) > 10 else "")
+        booky.messages.display_warning(f"{len(overwide)} tickets are probably wider "
+                                       f"than the page: {shown}")
+    result = dict(booklet_dict)
+    result['booklet'] = dict(booklet_dict['booklet'])
+    result['booklet']['pages'] = pack_tickets(layout, my_tickets)
+    logger.info(f"{len(my_tickets)} tickets packed on "
+                f"{len(result['booklet']['pages'])} pages.")
+    return result
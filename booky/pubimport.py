@@ -0,0 +1,174 @@
+### pubimport.py
+#
+# Bulk import of publications from CSV, TSV or JSONL.
+#
+# A new client's serials come as a spreadsheet export with a header row
+# naming the columns (key, title, block-height, block-width,
+# cover-height, cover-width, color), or as JSON lines with the same
+# names. The TSV and JSONL written by --list-full --format can be read
+# back as they are.
+#
+# Rows are read one at a time and each is checked as it comes: the
+# fields, the pub-validation colors and limits, and its key against the
+# database (with its journal) and the rows accepted before it. Accepted
+# rows go straight into a copy of the journal as add records and the
+# copy replaces the journal when the file has been read, so memory holds
+# only the set of keys, however long the file, and the import is seen
+# whole or not at all. --compact then folds them into pubs.toml.
+
+
+import os
+import csv
+import json
+import logging
+import booky.journal
+import booky.messages
+import booky.model
+import booky.validation
+
+logger = logging.getLogger('booky')
+
+IMPORT_FORMATS = {'.csv': 'csv', '.tsv': 'tsv', '.txt': 'tsv',
+                  '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+TSV_ESCAPES = {'\\\\': '\\', '\\t': '\t', '\\n': '\n', '\\r': '\r'}
+
+
+def import_format(import_filename):
+    extension = os.path.splitext(import_filename)[1].lower()
+    if extension not in IMPORT_FORMATS:
+        booky.messages.display_error(f"Can't tell the format of {import_filename}: use a "
+                                     f"{', '.join(IMPORT_FORMATS)} file.")
+        exit(1)
+    return IMPORT_FORMATS[extension]
+
+
+def column_name(name):
+    """Field name of a spreadsheet column heading: Block_Height is block-height."""
+    return name.strip().lower().replace('_', '-').replace(' ', '-')
+
+
+def tsv_value(value):
+    """Undo the escapes of publication.tsv_field."""
+    if '\\' not in value:
+        return value
+    import re
+    return re.sub(r'\\[\\tnr]', lambda m: TSV_ESCAPES[m.group(0)], value)
+
+
+def table_rows(f, import_filename, output_format):
+    """(line number, {field: string}) of the rows of a CSV or TSV file."""
+    if output_format == 'tsv':
+        reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+    else:
+        reader = csv.reader(f)
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [column_name(name) for name in header]
+    allowed = booky.validation.PUBLICATION['allowed'] | {'key'}
+    errors = [f"{import_filename}: unknown column {name!r}."
+              for name, column in zip(header, columns) if column not in allowed]
+    errors.extend(f"{import_filename}: no {field} column."
+                  for field in sorted(allowed) if field not in columns)
+    booky.validation.exit_on_errors(errors)
+    for values in reader:
+        if not any(values):
+            continue
+        if output_format == 'tsv':
+            values = [tsv_value(value) for value in values]
+        if len(values) != len(columns):
+            yield (reader.line_num, f"{len(values)} values, the header has {len(columns)}.")
+        else:
+            yield (reader.line_num, dict(zip(columns, values)))
+
+
+def jsonl_rows(f):
+    """(line number, {field: value}) of the lines of a JSONL file."""
+    for n, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield (n, f"not valid JSON: {e}")
+            continue
+        yield (n, row if isinstance(row, dict) else "not a JSON object.")
+
+
+def convert_row(row):
+    """The key and publication entry of a row, with numbers given as
+    strings converted. Values that are still wrong are left for
+    validation to report."""
+    types = booky.validation.PUBLICATION['types']
+    entry = {}
+    for field, value in row.items():
+        if isinstance(value, str):
+            value = value.strip()
+            if types.get(field) is int:
+                try:
+                    value = int(value)
+                except ValueError:
+                    pass
+        entry[field] = value
+    return (entry.pop('key', None), entry)
+
+
+def row_errors(where, key, entry, taken, imported, rules):
+    """Problems of one converted row, a list of messages."""
+    if not isinstance(key, str) or not key:
+        return [f"{where}: no key."]
+    if key in taken:
+        return [f"{where} [{key}]: key {key} already exists in pub database."]
+    if key in imported:
+        return [f"{where} [{key}]: key {key} is on an earlier line."]
+    errors = []
+    if booky.validation.validate_publication_entry(key, entry, where, errors):
+        errors.extend(booky.validation.validate_publications(
+            where, {key: booky.model.publication_from_toml(entry)}, rules))
+    return errors
+
+
+def accepted_records(import_filename, taken, rules, errors):
+    """The add records of the good rows of import_filename, read as they
+    are needed. taken is the set of keys in the database. The problems
+    of the other rows are added to errors."""
+    imported = set()
+    output_format = import_format(import_filename)
+    try:
+        with open(import_filename, encoding='utf-8-sig', newline='') as f:
+            if output_format == 'jsonl':
+                rows = jsonl_rows(f)
+            else:
+                rows = table_rows(f, import_filename, output_format)
+            for n, row in rows:
+                where = f"{import_filename} line {n}"
+                if isinstance(row, str):
+                    errors.append(f"{where}: {row}")
+                    continue
+                key, entry = convert_row(row)
+                problems = row_errors(where, key, entry, taken, imported, rules)
+                if problems:
+                    errors.extend(problems)
+                    continue
+                imported.add(key)
+                yield {'op': 'add', 'key': key, 'fields': entry}
+    except FileNotFoundError as e:
+        booky.messages.display_error(str(e))
+        exit(1)
+    except (UnicodeDecodeError, csv.Error) as e:
+        booky.messages.display_error(f"Can't read {import_filename}: {e}")
+        exit(1)
+
+
+def import_publications(import_filename, pubdb_filename, config_dict):
+    """Add the good rows of import_filename to the journal of
+    pubdb_filename. Returns (number imported, errors of the rest)."""
+    rules = booky.validation.pub_rules(config_dict)
+    errors = []
+    with booky.journal.locked(pubdb_filename):
+        taken = booky.journal.current_keys(pubdb_filename)
+        count = booky.journal.append_records(
+            pubdb_filename, accepted_records(import_filename, taken, rules, errors))
+    logger.info(f'{count} publications imported, {len(errors)} problems.')
+    return (count, errors)
@@ -0,0 +1,262 @@
+### pubindex.py
+#
+# Byte-offset index of a TOML pubdb.
+#
+# A booklet uses a dozen publications out of thousands, and --check-key
+# just one, yet loading pubs.toml parses every table in it. The index,
+# kept next to it in .pubs.toml.offsets, maps each publication key to
+# the byte range of its [key] table. With it, load_publications maps
+# the file into memory and hands tomllib only the tables that were asked
+# for, so the cost follows the booklet and not the catalogue.
+#
+# Finding the tables needs no TOML parsing: a table starts at a line
+# that is a [key] header. The index is rebuilt from the headers when the
+# file changes, and when the file has only grown (new publications added
+# at the end, which is how pubs.toml is usually edited) only the part
+# after the last indexed table is scanned again.
+#
+# Files the header scan can't be sure about (dotted or array table
+# headers, multi-line strings, keys outside any table, a key given
+# twice) get no index, and are loaded whole as before, with the full
+# error report.
+
+
+import os
+import re
+import mmap
+import array
+import bisect
+import marshal
+import logging
+import booky.messages
+import booky.model
+import booky.snapshot
+import booky.validation
+
+logger = logging.getLogger('booky')
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = 'offsets'
+
+HEADER = re.compile(rb'^[ \t]*\[(?!\[)([^\]\r\n]*)\][ \t]*(?:#[^\r\n]*)?\r?$', re.M)
+BARE_KEY = re.compile(r'[A-Za-z0-9_-]+')
+BASIC_KEY = re.compile(r'"(?:[^"\\]|\\.)*"')
+LITERAL_KEY = re.compile(r"'[^']*'")
+IGNORED_LINE = re.compile(rb'[ \t]*(?:#[^\r\n]*)?\r?')
+
+
+def header_key(raw):
+    """The key of a [key] table header, or None unless it is a single
+    bare, basic or literal key."""
+    import json
+    text = raw.decode('utf-8').strip()
+    if BARE_KEY.fullmatch(text):
+        return text
+    if BASIC_KEY.fullmatch(text):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return None
+    if LITERAL_KEY.fullmatch(text):
+        return text[1:-1]
+    return None
+
+
+def only_comments(data, start, end):
+    return all(IGNORED_LINE.fullmatch(line)
+               for line in data[start:end].split(b'\n'))
+
+
+def scan_tables(data, start, end):
+    """[(key, table start)] of the table headers in data[start:end], or
+    None if some header is not one the index can handle."""
+    headers = []
+    for match in HEADER.finditer(data, start, end):
+        key = header_key(match.group(1))
+        if key is None:
+            return None
+        headers.append((key, match.start()))
+    return headers
+
+
+def table_ranges(headers, end):
+    """{key: (start, end)} from scan_tables, or None if a key repeats."""
+    ranges = {}
+    for n, (key, start) in enumerate(headers):
+        if key in ranges:
+            return None
+        stop = headers[n + 1][1] if n + 1 < len(headers) else end
+        ranges[key] = (start, stop)
+    return ranges
+
+
+def build_index(data, size):
+    """{key: (start, end)} of all tables in data, or None."""
+    if data.find(b'"""') >= 0 or data.find(b"'''") >= 0:
+        return None
+    headers = scan_tables(data, 0, size)
+    if headers is None:
+        return None
+    if not only_comments(data, 0, headers[0][1] if headers else size):
+        return None
+    return table_ranges(headers, size)
+
+
+def extend_index(data, size, ranges, old_size):
+    """The index of data, which is the file of ranges grown from old_size
+    to size bytes. Only the last table and what follows it are scanned."""
+    if data.find(b'"""', old_size) >= 0 or data.find(b"'''", old_size) >= 0:
+        return None
+    if not ranges:
+        return build_index(data, size)
+    last_key, (last_start, _) = max(ranges.items(), key=lambda item: item[1][0])
+    headers = scan_tables(data, last_start, size)
+    if headers is None or not headers or headers[0] != (last_key, last_start):
+        return None
+    result = dict(ranges)
+    del result[last_key]
+    tail = table_ranges(headers, size)
+    if tail is None or not tail.keys().isdisjoint(result):
+        return None
+    result.update(tail)
+    return result
+
+
+# Stored, the index is the sorted keys as one string and the table
+# ranges as two arrays of offsets, which load far faster than a dict
+# of a hundred thousand keys.
+
+def make_index(ranges):
+    keys = sorted(ranges)
+    return {'keys': keys,
+            'starts': array.array('q', [ranges[key][0] for key in keys]),
+            'ends': array.array('q', [ranges[key][1] for key in keys])}
+
+
+def index_ranges(index):
+    return {key: (start, end)
+            for key, start, end in zip(index['keys'], index['starts'], index['ends'])}
+
+
+def lookup(index, keys):
+    """{key: (start, end)} of those of keys that are in index."""
+    index_keys = index['keys']
+    result = {}
+    for key in keys:
+        n = bisect.bisect_left(index_keys, key)
+        if n < len(index_keys) and index_keys[n] == key:
+            result[key] = (index['starts'][n], index['ends'][n])
+    return result
+
+
+def read_index(pubdb_filename):
+    """The stored index, as make_index makes it with the 'signature' and
+    'hash' of the file it is for, or None."""
+    try:
+        with open(booky.snapshot.snapshot_filename(pubdb_filename, INDEX_SUFFIX), 'rb') as f:
+            stored = marshal.load(f)
+        if not isinstance(stored, dict) or stored.get('version') != INDEX_VERSION:
+            return None
+        index = {'signature': tuple(stored['signature']),
+                 'hash': stored['hash'],
+                 'keys': stored['keys'].split('\n') if stored['keys'] else [],
+                 'starts': array.array('q'),
+                 'ends': array.array('q')}
+        index['starts'].frombytes(stored['starts'])
+        index['ends'].frombytes(stored['ends'])
+    except (OSError, EOFError, ValueError, TypeError, KeyError, AttributeError):
+        return None
+    return index
+
+
+def write_index(pubdb_filename, index):
+    index_filename = booky.snapshot.snapshot_filename(pubdb_filename, INDEX_SUFFIX)
+    tmp_filename = f"{index_filename}.{os.getpid()}.tmp"
+    stored = {'version': INDEX_VERSION,
+              'signature': index['signature'],
+              'hash': index['hash'],
+              'keys': "\n".join(index['keys']),
+              'starts': index['starts'].tobytes(),
+              'ends': index['ends'].tobytes()}
+    try:
+        with open(tmp_filename, 'wb') as f:
+            marshal.dump(stored, f)
+        os.replace(tmp_filename, index_filename)
+    except OSError as e:
+        logger.info(f'could not write index {index_filename}: {e}')
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+
+
+def prefix_hash(data, size):
+    with memoryview(data) as view:
+        return booky.snapshot.source_hash(view[:size])
+
+
+def current_index(pubdb_filename, data, signature):
+    """The index (see make_index) of data, the mapped contents of
+    pubdb_filename, updating the stored index as needed. None if the
+    file can't be indexed."""
+    size = signature[1]
+    index = read_index(pubdb_filename)
+    if index is not None and index['signature'] == signature:
+        return index
+
+    ranges = None
+    old_size = index['signature'][1] if index is not None else None
+    if old_size is not None and old_size == size and prefix_hash(data, size) == index['hash']:
+        # Touched but not changed.
+        ranges = index_ranges(index)
+    elif old_size is not None and old_size < size and prefix_hash(data, old_size) == index['hash']:
+        ranges = extend_index(data, size, index_ranges(index), old_size)
+        if ranges is not None:
+            logger.info('pubdb index extended.')
+    if ranges is None:
+        ranges = build_index(data, size)
+    # Keys are stored one per line.
+    if ranges is None or any('\n' in key for key in ranges):
+        logger.info(f'{pubdb_filename} can not be indexed.')
+        return None
+    index = make_index(ranges)
+    index['signature'] = signature
+    index['hash'] = prefix_hash(data, size)
+    write_index(pubdb_filename, index)
+    logger.info('pubdb index written.')
+    return index
+
+
+def load_publications(pubdb_filename, keys):
+    """pubdb_dict of those of keys that are in the TOML pubdb, in key
+    order, parsing only their tables. None if the file can't be indexed."""
+    try:
+        with open(pubdb_filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            signature = (st.st_mtime_ns, st.st_size)
+            if st.st_size == 0:
+                return {}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                index = current_index(pubdb_filename, data, signature)
+                if index is None:
+                    return None
+                ranges = lookup(index, set(keys))
+                wanted = sorted(ranges)
+                source = b"\n".join([data[ranges[key][0]:ranges[key][1]] for key in wanted])
+    except FileNotFoundError as f:
+        booky.messages.display_error(str(f))
+        exit(1)
+    if not wanted:
+        logger.info('0 publications loaded through the index.')
+        return {}
+    # tomllib only for the tables found: checking a new key doesn't parse.
+    import tomllib
+    try:
+        tables = tomllib.loads(source.decode('utf-8'))
+    except (tomllib.TOMLDecodeError, UnicodeDecodeError):
+        booky.messages.display_toml_error(pubdb_filename)
+        exit(1)
+    booky.validation.exit_on_errors(
+        booky.validation.validate_pubdb_entries(pubdb_filename, tables))
+    logger.info(f'{len(tables)} publications loaded through the index.')
+    return {key: booky.model.publication_from_toml(tables[key]) for key in wanted}
@@ -1,44 +1,216 @@
 ### publication.py
 
 
-import tomllib
+import logging
+import re
 import fnmatch
-import rich.table, rich.console
+import bisect
+import itertools
+import array
+import booky.journal
 import booky.messages
+import booky.model
+import booky.snapshot
+import booky.timing
+import booky.validation
 
 
-def load_pubdb(pubdb_filename):
-    """Load publication.toml database into pubdb_dict and verify it (to do)."""    
+logger = logging.getLogger('booky')
+
+@booky.timing.timed('parse pubdb')
+def parse_pubdb(pubdb_filename):
+    """Parse the TOML database. Returns (signature, hash, pubdb_dict) with
+    pubdb_dict rebuilt in sorted key order."""
+    import tomllib
     try:
+        signature = booky.snapshot.source_signature(pubdb_filename)
         with open(pubdb_filename, 'rb') as f:
-            pubdb_dict = tomllib.load(f)
-    except tomllib.TOMLDecodeError: 
-        booky.messages.display_toml_error(config_filename)
+            source_bytes = f.read()
+        pubdb_dict = tomllib.loads(source_bytes.decode('utf-8'))
+    except (tomllib.TOMLDecodeError, UnicodeDecodeError):
+        booky.messages.display_toml_error(pubdb_filename)
         exit(1)
     except FileNotFoundError as f:
         booky.messages.display_error(str(f))
         exit(1)
+    booky.validation.exit_on_errors(
+        booky.validation.validate_pubdb_entries(pubdb_filename, pubdb_dict))
+    pubdb_dict = {key: booky.model.publication_from_toml(pubdb_dict[key])
+                  for key in sorted(pubdb_dict.keys())}
+    return (signature, booky.snapshot.source_hash(source_bytes), pubdb_dict)
+
+
+# Backends. A pubdb is either a TOML file (pubs.toml) or an SQLite
+# database (see booky.pubsqlite), chosen by the pub-db-backend setting of
+# configure.toml or else by the file extension.
+
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+
+
+def is_sharded(pubdb_filename):
+    """True if pubdb_filename names a directory or glob of TOML shards,
+    see booky.pubshards."""
+    import os.path
+    import glob
+    return os.path.isdir(pubdb_filename) or glob.has_magic(pubdb_filename)
+
+
+def pubdb_signature(pubdb_filename):
+    """Changes whenever the pubdb, one of its shards or its journal
+    changes."""
+    import booky.pubshards
+    if is_sharded(pubdb_filename):
+        return booky.pubshards.shards_signature(pubdb_filename)
+    return (booky.snapshot.source_signature(pubdb_filename),
+            booky.journal.journal_signature(pubdb_filename))
+
+
+def pubdb_backend(pubdb_filename, backend=None):
+    """'toml' or 'sqlite'. backend is the configured pub-db-backend, if any."""
+    if backend is not None:
+        return backend
+    if pubdb_filename.lower().endswith(SQLITE_EXTENSIONS):
+        return 'sqlite'
+    return 'toml'
+
+
+@booky.timing.timed('load pubdb')
+def load_pubdb(pubdb_filename, backend=None):
+    """The whole pubdb_dict, in key order, from either backend."""
+    import booky.pubshards
+    import booky.pubsqlite
+    if pubdb_backend(pubdb_filename, backend) == 'sqlite':
+        return booky.pubsqlite.load_pubdb(pubdb_filename)
+    if is_sharded(pubdb_filename):
+        return booky.pubshards.load_pubdb(pubdb_filename)
+    return booky.journal.replay(pubdb_filename, load_pubdb_toml(pubdb_filename))
+
+
+@booky.timing.timed('load publications')
+def load_publications(pubdb_filename, keys, backend=None):
+    """pubdb_dict of those of keys that are in the database. An SQLite
+    pubdb reads just these rows, a TOML pubdb just these tables (see
+    booky.pubindex) unless it can't be indexed and is loaded whole."""
+    import booky.pubindex
+    import booky.pubshards
+    import booky.pubsqlite
+    if pubdb_backend(pubdb_filename, backend) == 'sqlite':
+        return booky.pubsqlite.load_publications(pubdb_filename, keys)
+    if is_sharded(pubdb_filename):
+        return booky.pubshards.load_publications(pubdb_filename, keys)
+    keys = set(keys)
+    pubdb_dict = booky.pubindex.load_publications(pubdb_filename, keys)
+    if pubdb_dict is None:
+        pubdb_dict = load_pubdb_toml(pubdb_filename)
+        pubdb_dict = {key: pubdb_dict[key] for key in sorted(keys) if key in pubdb_dict}
+    return booky.journal.replay(pubdb_filename, pubdb_dict, keys)
+
+
+def toml_key(key):
+    if re.fullmatch(r'[A-Za-z0-9_-]+', key):
+        return key
+    return toml_string(key)
+
+
+def toml_string(s):
+    # A JSON string is a valid TOML basic string.
+    import json
+    return json.dumps(s, ensure_ascii=False)
 
+
+def dump_pubdb_toml(pubdb_dict, f):
+    """Write pubdb_dict to the text file f in the layout of pubs.toml:
+    one table per publication, fields in alphabetical order."""
+    fields = sorted(booky.model.PUBLICATION_TOML_FIELDS)
+    for key, pub in pubdb_dict.items():
+        lines = [f"[{toml_key(key)}]\n"]
+        for field in fields:
+            value = pub[field]
+            value = toml_string(value) if isinstance(value, str) else str(value)
+            lines.append(f"{field} = {value}\n")
+        lines.append("\n")
+        f.writelines(lines)
+
+
+def write_pubdb_toml(pubdb_filename, pubdb_dict):
+    """Write pubdb_dict as the TOML file pubdb_filename, atomically."""
+    import os
+    temp_filename = f"{pubdb_filename}.{os.getpid()}.tmp"
+    try:
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            dump_pubdb_toml(pubdb_dict, f)
+        os.replace(temp_filename, pubdb_filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    logger.info(f'{len(pubdb_dict)} publications written to {pubdb_filename}.')
+
+
+def load_pubdb_toml(pubdb_filename):
+    """Load publication.toml database into pubdb_dict and verify that
+    every entry has the expected fields.
+
+    pubdb_dict maps keys to booky.model.Publication. The parsed database
+    is kept in a marshal snapshot next to the TOML file (as plain tuples)
+    and reused for as long as the TOML file is unchanged. The returned
+    pubdb_dict is always in sorted key order, so the display functions
+    and searches need not sort it again."""
+    snapshot = booky.snapshot.read_snapshot(pubdb_filename)
+    if snapshot is not None:
+        make = booky.model.Publication._make
+        pubdb_dict = {key: make(t) for key, t in snapshot.items()}
+        logger.info('pubdb_dict loaded from snapshot.')
+        return pubdb_dict
+
+    signature, hash_value, pubdb_dict = parse_pubdb(pubdb_filename)
+    logger.info('pubdb_dict loaded.')
+    booky.snapshot.write_snapshot(pubdb_filename, signature, hash_value,
+                                  {key: tuple(pub) for key, pub in pubdb_dict.items()})
     return pubdb_dict
 
 
-def display_pubdb_narrow(title, pubdb_dict):
+def pubdb_slice(pubdb_dict, offset=0, limit=None):
+    """The (key, publication) items of pubdb_dict from offset on, at most
+    limit of them."""
+    stop = None if limit is None else offset + limit
+    return itertools.islice(pubdb_dict.items(), offset, stop)
+
+
+def slice_caption(pubdb_dict, offset, limit):
+    """'Rows 21-40 of 1234' when only part of pubdb_dict is shown."""
+    total = len(pubdb_dict)
+    if offset == 0 and (limit is None or limit >= total):
+        return None
+    last = total if limit is None else min(total, offset + limit)
+    return f"Rows {min(offset + 1, total)}-{last} of {total}"
+
+
+def display_pubdb_narrow(title, pubdb_dict, offset=0, limit=None):
+    """pubdb_dict is expected in key order, as given by load_pubdb
+    and the searches. Only limit rows from offset on are shown."""
+    import rich.table
     key_style = 'bold magenta'
     title_style = 'white'
-    table = rich.table.Table(title=title)
+    table = rich.table.Table(title=title,
+                             caption=slice_caption(pubdb_dict, offset, limit))
     table.add_column('Key', justify='right', style=key_style)
     table.add_column('Title', style=title_style)
-    for key in sorted(pubdb_dict.keys()):
-        table.add_row(key, pubdb_dict[key]['title'])
-    console = rich.console.Console()
+    for key, pub in pubdb_slice(pubdb_dict, offset, limit):
+        table.add_row(key, pub.title)
+    console = booky.messages.make_console()
     print()
     console.print(table)
     print()
 
 
-def display_pubdb_wide(title, pubdb_dict):
+def display_pubdb_wide(title, pubdb_dict, offset=0, limit=None):
+    """pubdb_dict is expected in key order, as given by load_pubdb
+    and the searches. Only limit rows from offset on are shown."""
+    import rich.table
     data_color = 'white'
-    table = rich.table.Table(title=title, show_lines=True)
+    table = rich.table.Table(title=title, show_lines=True,
+                             caption=slice_caption(pubdb_dict, offset, limit))
     table.add_column('Key', justify='right', style='bold magenta')
     table.add_column('Title', style='white')
     table.add_column('BH',style=data_color)
@@ -46,33 +218,286 @@ def display_pubdb_wide(title, pubdb_dict):
     table.add_column('CH',style=data_color)
     table.add_column('CW',style=data_color)
     table.add_column('Color',style=data_color)
-    for key in sorted(pubdb_dict.keys()):
+    for key, pub in pubdb_slice(pubdb_dict, offset, limit):
         table.add_row(key,
-                      pubdb_dict[key]['title'],
-                      str(pubdb_dict[key]['block-height']),
-                      str(pubdb_dict[key]['block-width']),
-                      str(pubdb_dict[key]['cover-height']),
-                      str(pubdb_dict[key]['cover-width']),
-                      str(pubdb_dict[key]['color']))
-    console = rich.console.Console()
+                      pub.title,
+                      str(pub.block_height),
+                      str(pub.block_width),
+                      str(pub.cover_height),
+                      str(pub.cover_width),
+                      str(pub.color))
+    console = booky.messages.make_console()
     print()
     console.print(table)
     print()
 
 
-def search_keys_pubdb(search_arg, pubdb_dict):
+# Machine-readable output. Rows are written one at a time as they are
+# produced, without rich: json is one array of objects, jsonl one object
+# per line, tsv a header line and then tab-separated fields (with tabs,
+# newlines and backslashes in titles written as \t, \n and \\).
+
+OUTPUT_FORMATS = ['json', 'jsonl', 'tsv']
+
+NARROW_FIELDS = ['key', 'title']
+WIDE_FIELDS = ['key', 'title', 'block-height', 'block-width',
+               'cover-height', 'cover-width', 'color']
+
+
+def tsv_field(value):
+    if not isinstance(value, str):
+        return str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def output_lines(items, output_format, fields):
+    """Lines of text for the (key, publication) items."""
+    import json
+    names = fields[1:]
+    if output_format == 'tsv':
+        yield "\t".join(fields) + "\n"
+        for key, pub in items:
+            yield "\t".join([tsv_field(key)] + [tsv_field(pub[n]) for n in names]) + "\n"
+        return
+    dumps = json.JSONEncoder(ensure_ascii=False).encode
+    objects = (dumps({'key': key, **{n: pub[n] for n in names}}) for key, pub in items)
+    if output_format == 'jsonl':
+        for line in objects:
+            yield line + "\n"
+        return
+    separator = "[\n"
+    for line in objects:
+        yield separator + line
+        separator = ",\n"
+    yield "[]\n" if separator == "[\n" else "\n]\n"
+
+
+def write_pubdb(pubdb_dict, output_format, wide=True, offset=0, limit=None, f=None):
+    """Write pubdb_dict to f (standard output) in output_format, all fields
+    or (wide false) only key and title."""
+    import sys
+    f = f or sys.stdout
+    fields = WIDE_FIELDS if wide else NARROW_FIELDS
+    f.writelines(output_lines(pubdb_slice(pubdb_dict, offset, limit), output_format, fields))
+    f.flush()
+
+
+# Search index.
+#
+# Searches are fnmatch patterns matched case-insensitively against keys
+# or titles. Instead of running fnmatch over every entry, the index
+# narrows the candidates first:
+#
+#  - a literal prefix (the "abc" in "abc*") is a bisect range in the
+#    sorted list of case-folded strings;
+#  - every literal run of 3 or more characters (the "THEO" in "*theo*")
+#    must contain all of its trigrams, so the posting lists of those
+#    trigrams are intersected.
+#
+# The survivors still go through fnmatch, so the index never changes a
+# result, it only avoids looking at entries that cannot match. Positions
+# refer to the key order of pubdb_dict. Posting lists are kept as bytes
+# of an unsigned int array so that the index marshals and loads quickly.
+
+NGRAM = 3
+WILDCARDS = '*?['
+
+
+def fold(s):
+    return s.upper()
+
+
+def build_field_index(folded):
+    order = sorted(range(len(folded)), key=folded.__getitem__)
+    grams = {}
+    for position, s in enumerate(folded):
+        for gram in {s[i:i+NGRAM] for i in range(len(s) - NGRAM + 1)}:
+            grams.setdefault(gram, array.array('I')).append(position)
+    return {'sorted': [folded[i] for i in order],
+            'order': array.array('I', order).tobytes(),
+            'grams': {gram: postings.tobytes() for gram, postings in grams.items()}}
+
+
+def build_search_index(pubdb_dict):
+    """Build the search index for keys and titles of pubdb_dict."""
+    keys = list(pubdb_dict.keys())
+    return {'keys': keys,
+            'key-index': build_field_index([fold(key) for key in keys]),
+            'title-index': build_field_index([fold(pubdb_dict[key].title)
+                                              for key in keys])}
+
+
+@booky.timing.timed('load search index')
+def load_search_index(pubdb_filename, pubdb_dict):
+    """Search index for pubdb_dict, loaded from its sidecar snapshot next
+    to pubdb_filename, or built and saved there. A sharded pubdb has no
+    single file to keep it next to, and a pubdb with a journal differs
+    from its file, so for those it is always built."""
+    if is_sharded(pubdb_filename) or booky.journal.journal_signature(pubdb_filename):
+        return build_search_index(pubdb_dict)
+    search_index = booky.snapshot.read_snapshot(pubdb_filename, 'idx')
+    if search_index is not None and len(search_index['keys']) == len(pubdb_dict):
+        logger.info('search index loaded from snapshot.')
+        return search_index
+    search_index = build_search_index(pubdb_dict)
+    logger.info('search index built.')
+    try:
+        signature = booky.snapshot.source_signature(pubdb_filename)
+        with open(pubdb_filename, 'rb') as f:
+            hash_value = booky.snapshot.source_hash(f.read())
+    except OSError:
+        return search_index
+    booky.snapshot.write_snapshot(pubdb_filename, signature, hash_value,
+                                  search_index, 'idx')
+    return search_index
+
+
+def pattern_literals(pattern):
+    """Split a (folded) fnmatch pattern into the literal runs between its
+    wildcards. Returns (prefix, runs, exact) where prefix is the first run
+    and exact is true if the pattern has no wildcards at all."""
+    runs = ['']
+    exact = True
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c in '*?':
+            exact = False
+            runs.append('')
+        elif c == '[':
+            exact = False
+            # Find the end of the [...] set the way fnmatch does.
+            j = i + 1
+            if j < len(pattern) and pattern[j] == '!':
+                j += 1
+            if j < len(pattern) and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j == -1:
+                runs[-1] += c
+            else:
+                runs.append('')
+                i = j
+        else:
+            runs[-1] += c
+        i += 1
+    return (runs[0], runs, exact)
+
+
+def postings(field_index, name, gram=None):
+    result = array.array('I')
+    if gram is None:
+        result.frombytes(field_index[name])
+    else:
+        result.frombytes(field_index[name].get(gram, b''))
+    return result
+
+
+def search_field(pattern, field_index, folded_at):
+    """Positions of the entries of field_index that match pattern, in key
+    order. folded_at(position) gives the folded string to match."""
+    prefix, runs, exact = pattern_literals(pattern)
+
+    candidates = None
+    if prefix:
+        lo = bisect.bisect_left(field_index['sorted'], prefix)
+        if exact:
+            hi = bisect.bisect_right(field_index['sorted'], prefix, lo)
+        else:
+            hi = bisect.bisect_left(field_index['sorted'], prefix + '\U0010ffff', lo)
+        candidates = set(postings(field_index, 'order')[lo:hi])
+
+    if not exact:
+        grams = {run[i:i+NGRAM] for run in runs for i in range(len(run) - NGRAM + 1)}
+        gram_postings = field_index['grams']
+        for gram in sorted(grams, key=lambda g: len(gram_postings.get(g, b''))):
+            if candidates is not None and not candidates:
+                break
+            posting = postings(field_index, 'grams', gram)
+            if candidates is None:
+                candidates = set(posting)
+            else:
+                candidates.intersection_update(posting)
+
+    if candidates is None:
+        candidates = range(len(field_index['sorted']))
+    else:
+        candidates = sorted(candidates)
+    match = re.compile(fnmatch.translate(pattern)).match
+    return [i for i in candidates if match(folded_at(i))]
+
+
+@booky.timing.timed('search keys')
+def search_keys_pubdb(search_arg, pubdb_dict, search_index=None):
+    """Case-insensitive wildcard search of the keys. Without a search_index
+    (see load_search_index) every key is matched in turn."""
+    if search_index is not None:
+        keys = search_index['keys']
+        positions = search_field(fold(search_arg), search_index['key-index'],
+                                 lambda i: fold(keys[i]))
+        return {keys[i]: pubdb_dict[keys[i]] for i in positions}
     result = {}
-    for key in sorted(pubdb_dict.keys()):
+    for key in pubdb_dict.keys():
         if fnmatch.fnmatchcase(key.upper(), search_arg.upper()):
             result[key] = pubdb_dict[key]
     return result
 
            
-def search_titles_pubdb(search_arg, pubdb_dict):
+@booky.timing.timed('search titles')
+def search_titles_pubdb(search_arg, pubdb_dict, search_index=None):
+    """Case-insensitive wildcard search of the titles. Without a search_index
+    (see load_search_index) every title is matched in turn."""
+    if search_index is not None:
+        keys = search_index['keys']
+        positions = search_field(fold(search_arg), search_index['title-index'],
+                                 lambda i: fold(pubdb_dict[keys[i]].title))
+        return {keys[i]: pubdb_dict[keys[i]] for i in positions}
     result = {}
-    for key in sorted(pubdb_dict.keys()):
-        if fnmatch.fnmatchcase(pubdb_dict[key]['title'].upper(), 
+    for key in pubdb_dict.keys():
+        if fnmatch.fnmatchcase(pubdb_dict[key].title.upper(), 
                                search_arg.upper()):
             result[key] = pubdb_dict[key]
     return result
 
+
+# Fuzzy search.
+#
+# A ranked search of the titles for a misspelled or half remembered
+# term. The candidates are the titles sharing the most trigrams with the
+# term, counted from the postings of the search index, and they are
+# ranked by the edit distance of the term to the closest part of the
+# title (booky.duplicates.substring_distance), then to the whole title.
+
+FUZZY_RESULTS = 10
+FUZZY_CANDIDATES = 200
+
+
+@booky.timing.timed('fuzzy search titles')
+def fuzzy_search_titles_pubdb(search_arg, pubdb_dict, count=FUZZY_RESULTS,
+                              search_index=None):
+    """The count publications whose titles are most like search_arg, best
+    first. Without a search_index it is built."""
+    import collections
+    import booky.duplicates
+    if search_index is None:
+        search_index = build_search_index(pubdb_dict)
+    keys = search_index['keys']
+    folded = fold(search_arg)
+    shared = collections.Counter()
+    for gram in {folded[i:i+NGRAM] for i in range(len(folded) - NGRAM + 1)}:
+        shared.update(postings(search_index['title-index'], 'grams', gram))
+    if shared:
+        candidates = [i for i, n in shared.most_common(max(FUZZY_CANDIDATES, count))]
+    else:
+        candidates = range(len(keys))
+    query = booky.duplicates.normalize(search_arg)
+
+    def rank(i):
+        title = booky.duplicates.normalize(pubdb_dict[keys[i]].title)
+        return (booky.duplicates.substring_distance(query, title),
+                booky.duplicates.edit_distance(query, title, max(len(query), len(title))),
+                keys[i])
+
+    best = sorted(candidates, key=rank)[:count]
+    return {keys[i]: pubdb_dict[keys[i]] for i in best}
@@ -0,0 +1,226 @@
+### pubshards.py
+#
+# A publication database split into shards.
+#
+# pub-db-filename can name a directory (every .toml file in it is a
+# shard) or a glob pattern such as "pubs/*.toml", so that each publisher
+# or year has a file of its own and editors don't trip over each other.
+# A shard is an ordinary pubs.toml, with its own snapshot and offset
+# index.
+#
+# load_pubdb reads the shards that have a valid snapshot directly and
+# parses the others in a process pool, then merges them. A key found in
+# more than one shard is an error, reported with the shards it is in.
+#
+# For lookups of a few keys, a manifest of which key is in which shard
+# (kept in .booky-cache/manifests) sends load_publications to just the
+# shards that hold them. It is remade from the offset indexes of the
+# shards whenever one of them changes.
+
+
+import os
+import glob
+import mmap
+import array
+import bisect
+import marshal
+import hashlib
+import logging
+import booky.messages
+import booky.model
+import booky.pubindex
+import booky.publication
+import booky.snapshot
+import booky.validation
+
+logger = logging.getLogger('booky')
+
+MANIFEST_VERSION = 1
+MANIFEST_DIRECTORY = os.path.join(".booky-cache", "manifests")
+
+
+def shard_pattern(pubdb_filename):
+    if os.path.isdir(pubdb_filename):
+        return os.path.join(pubdb_filename, "*.toml")
+    return pubdb_filename
+
+
+def shard_filenames(pubdb_filename):
+    """The shards of pubdb_filename, in sorted order."""
+    filenames = sorted(glob.glob(shard_pattern(pubdb_filename)))
+    if not filenames:
+        booky.messages.display_error(f"No publication database matches {pubdb_filename}.")
+        exit(1)
+    return filenames
+
+
+def shards_signature(pubdb_filename):
+    """Changes whenever a shard is added, removed or changed."""
+    return tuple([(filename,) + booky.snapshot.source_signature(filename)
+                  for filename in shard_filenames(pubdb_filename)])
+
+
+def parse_shard(shard_filename):
+    """Parse and check one shard, in a worker process. Returns
+    (signature, hash, {key: tuple}, errors); errors are shown by the
+    parent."""
+    import tomllib
+    try:
+        signature = booky.snapshot.source_signature(shard_filename)
+        with open(shard_filename, 'rb') as f:
+            source_bytes = f.read()
+        toml_dict = tomllib.loads(source_bytes.decode('utf-8'))
+    except (tomllib.TOMLDecodeError, UnicodeDecodeError) as e:
+        return (None, None, {}, [f"{shard_filename} is not valid TOML: {e}"])
+    except OSError as e:
+        return (None, None, {}, [f"cannot read {shard_filename}: {e.strerror}"])
+    errors = booky.validation.validate_pubdb_entries(shard_filename, toml_dict)
+    if errors:
+        return (None, None, {}, errors)
+    payload = {key: tuple(booky.model.publication_from_toml(toml_dict[key]))
+               for key in sorted(toml_dict)}
+    return (signature, booky.snapshot.source_hash(source_bytes), payload, [])
+
+
+def duplicate_errors(shard_keys):
+    """Errors for keys in more than one shard. shard_keys is a list of
+    (shard filename, keys)."""
+    shards_of = {}
+    for shard_filename, keys in shard_keys:
+        for key in keys:
+            shards_of.setdefault(key, []).append(shard_filename)
+    return [f"publication {key} is in more than one shard: {', '.join(shards)}."
+            for key, shards in sorted(shards_of.items()) if len(shards) > 1]
+
+
+def load_pubdb(pubdb_filename, jobs=None):
+    """The merged pubdb_dict of all shards, in key order."""
+    filenames = shard_filenames(pubdb_filename)
+    payloads = {}
+    to_parse = []
+    for filename in filenames:
+        payload = booky.snapshot.read_snapshot(filename)
+        if payload is None:
+            to_parse.append(filename)
+        else:
+            payloads[filename] = payload
+
+    errors = []
+    workers = min(len(to_parse), jobs or os.cpu_count() or 1)
+    if workers > 1:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(parse_shard, to_parse))
+    else:
+        results = [parse_shard(filename) for filename in to_parse]
+    for filename, (signature, hash_value, payload, shard_errors) in zip(to_parse, results):
+        errors.extend(shard_errors)
+        if not shard_errors:
+            booky.snapshot.write_snapshot(filename, signature, hash_value, payload)
+            payloads[filename] = payload
+    logger.info(f'{len(filenames)} shards loaded, {len(to_parse)} of them parsed.')
+
+    errors.extend(duplicate_errors(list(payloads.items())))
+    booky.validation.exit_on_errors(errors)
+
+    make = booky.model.Publication._make
+    merged = {}
+    for payload in payloads.values():
+        merged.update(payload)
+    return {key: make(merged[key]) for key in sorted(merged)}
+
+
+# The manifest.
+
+def manifest_filename(pubdb_filename):
+    name = hashlib.blake2b(os.path.abspath(pubdb_filename).encode('utf-8'),
+                           digest_size=8).hexdigest()
+    return os.path.join(MANIFEST_DIRECTORY, name)
+
+
+def read_manifest(pubdb_filename, signature):
+    """The stored manifest if it is for the shards of signature: a dict
+    with the sorted 'keys' and, for each, its shard number in 'shards'
+    (an index into 'filenames')."""
+    try:
+        with open(manifest_filename(pubdb_filename), 'rb') as f:
+            stored = marshal.load(f)
+        if (not isinstance(stored, dict) or stored.get('version') != MANIFEST_VERSION
+                or tuple(map(tuple, stored['signature'])) != signature):
+            return None
+        shards = array.array('l')
+        shards.frombytes(stored['shards'])
+        return {'filenames': [s[0] for s in signature],
+                'keys': stored['keys'].split('\n') if stored['keys'] else [],
+                'shards': shards}
+    except (OSError, EOFError, ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+def shard_keys(shard_filename):
+    """All keys of a shard, from its offset index when it has one."""
+    with open(shard_filename, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            index = booky.pubindex.current_index(shard_filename, data,
+                                                 (st.st_mtime_ns, st.st_size))
+    if index is not None:
+        return index['keys']
+    return list(booky.publication.load_pubdb_toml(shard_filename))
+
+
+def make_manifest(pubdb_filename, signature):
+    filenames = [s[0] for s in signature]
+    keys_of = [(filename, shard_keys(filename)) for filename in filenames]
+    booky.validation.exit_on_errors(duplicate_errors(keys_of))
+    shard_of = {key: n for n, (filename, keys) in enumerate(keys_of) for key in keys}
+    keys = sorted(shard_of)
+    if any('\n' in key for key in keys):
+        return None
+    manifest = {'filenames': filenames,
+                'keys': keys,
+                'shards': array.array('l', [shard_of[key] for key in keys])}
+    filename = manifest_filename(pubdb_filename)
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(MANIFEST_DIRECTORY, exist_ok=True)
+        with open(tmp_filename, 'wb') as f:
+            marshal.dump({'version': MANIFEST_VERSION,
+                          'signature': signature,
+                          'keys': "\n".join(keys),
+                          'shards': manifest['shards'].tobytes()}, f)
+        os.replace(tmp_filename, filename)
+    except OSError as e:
+        logger.info(f'could not write manifest {filename}: {e}')
+    logger.info(f'manifest of {len(keys)} keys in {len(filenames)} shards written.')
+    return manifest
+
+
+def load_publications(pubdb_filename, keys):
+    """pubdb_dict of those of keys that are in the shards, reading only
+    the shards (and, through their offset indexes, the tables) that hold
+    them."""
+    signature = shards_signature(pubdb_filename)
+    manifest = read_manifest(pubdb_filename, signature) or make_manifest(pubdb_filename,
+                                                                          signature)
+    if manifest is None:
+        pubdb_dict = load_pubdb(pubdb_filename)
+        return {key: pubdb_dict[key] for key in sorted(set(keys)) if key in pubdb_dict}
+
+    manifest_keys = manifest['keys']
+    wanted = {}
+    for key in set(keys):
+        n = bisect.bisect_left(manifest_keys, key)
+        if n < len(manifest_keys) and manifest_keys[n] == key:
+            shard_filename = manifest['filenames'][manifest['shards'][n]]
+            wanted.setdefault(shard_filename, []).append(key)
+    result = {}
+    for shard_filename, keys_in_shard in wanted.items():
+        pubdb_dict = booky.pubindex.load_publications(shard_filename, keys_in_shard)
+        if pubdb_dict is None:
+            pubdb_dict = booky.publication.load_pubdb_toml(shard_filename)
+            pubdb_dict = {key: pubdb_dict[key] for key in keys_in_shard}
+        result.update(pubdb_dict)
+    return {key: result[key] for key in sorted(result)}
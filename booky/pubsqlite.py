@@ -0,0 +1,180 @@
+### pubsqlite.py
+#
+# SQLite storage for the publication database.
+#
+# A TOML pubdb has to be read whole for every command. In an SQLite
+# pubdb each publication is a row of the publication table, with indexes
+# on the case-folded key and title, so that --check-key, the searches and
+# booklet builds only read the rows they need.
+#
+# Keys and titles are folded in Python (booky.publication.fold) and the
+# folded strings are stored alongside, since SQLite's upper() only knows
+# ASCII. Searches hand SQLite a GLOB pattern (the same syntax as fnmatch
+# minus [...] sets), which it answers from the index when the pattern has
+# a literal prefix. The rows that come back are still matched with the
+# fnmatch regex, so results are the same as with a TOML pubdb.
+#
+# sqlite3 is imported when a database is opened: booky.publication
+# imports this module for every command, whichever backend is in use.
+
+
+import os
+import re
+import pathlib
+import fnmatch
+import logging
+import booky.messages
+import booky.model
+import booky.publication
+import booky.timing
+
+
+logger = logging.getLogger('booky')
+
+# PRAGMA user_version of a booky database. Bump it when the schema changes.
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE publication (
+    key TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    color TEXT NOT NULL,
+    block_height INTEGER NOT NULL,
+    block_width INTEGER NOT NULL,
+    cover_height INTEGER NOT NULL,
+    cover_width INTEGER NOT NULL,
+    key_folded TEXT NOT NULL,
+    title_folded TEXT NOT NULL
+);
+CREATE INDEX publication_key_folded ON publication (key_folded);
+CREATE INDEX publication_title_folded ON publication (title_folded);
+"""
+
+COLUMNS = "key, " + ", ".join(booky.model.Publication._fields)
+
+# SQLite limits the number of ? parameters of a statement.
+MAX_PARAMETERS = 500
+
+
+def connect(db_filename):
+    """Open an existing booky database read-only."""
+    import sqlite3
+    if not os.path.exists(db_filename):
+        booky.messages.display_error(f"No such file: '{db_filename}'")
+        exit(1)
+    try:
+        uri = pathlib.Path(db_filename).absolute().as_uri() + "?mode=ro"
+        connection = sqlite3.connect(uri, uri=True)
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        booky.messages.display_error(f"{db_filename} is not an SQLite database: {e}")
+        exit(1)
+    if version != SCHEMA_VERSION:
+        connection.close()
+        booky.messages.display_error(f"{db_filename} is not a Booky publication database "
+                                     f"(schema version {version}, expected {SCHEMA_VERSION}).\n"
+                                     "Use --pubdb-import to make one from a TOML database.")
+        exit(1)
+    return connection
+
+
+def query(db_filename, sql, parameters=()):
+    """pubdb_dict of the rows selected by sql, which selects COLUMNS."""
+    make = booky.model.Publication._make
+    connection = connect(db_filename)
+    try:
+        return {row[0]: make(row[1:]) for row in connection.execute(sql, parameters)}
+    finally:
+        connection.close()
+
+
+def load_pubdb(db_filename):
+    """The whole database as a pubdb_dict, in key order."""
+    pubdb_dict = query(db_filename, f"SELECT {COLUMNS} FROM publication ORDER BY key")
+    logger.info('pubdb_dict loaded from SQLite.')
+    return pubdb_dict
+
+
+def lookup_publication(db_filename, key):
+    """The publication of key, or None."""
+    return query(db_filename,
+                 f"SELECT {COLUMNS} FROM publication WHERE key = ?", (key,)).get(key)
+
+
+def load_publications(db_filename, keys):
+    """pubdb_dict of those of keys that are in the database, in key order."""
+    keys = sorted(set(keys))
+    make = booky.model.Publication._make
+    result = {}
+    connection = connect(db_filename)
+    try:
+        for start in range(0, len(keys), MAX_PARAMETERS):
+            chunk = keys[start:start + MAX_PARAMETERS]
+            marks = ", ".join("?" * len(chunk))
+            for row in connection.execute(f"SELECT {COLUMNS} FROM publication "
+                                          f"WHERE key IN ({marks}) ORDER BY key", chunk):
+                result[row[0]] = make(row[1:])
+    finally:
+        connection.close()
+    return result
+
+
+@booky.timing.timed('sqlite search')
+def search(db_filename, column, search_arg):
+    """pubdb_dict of the rows whose folded column matches the fnmatch
+    pattern search_arg, case-insensitively."""
+    pattern = booky.publication.fold(search_arg)
+    prefix, runs, exact = booky.publication.pattern_literals(pattern)
+    if exact:
+        where, parameters = f"{column} = ?", (pattern,)
+    elif '[' not in pattern:
+        where, parameters = f"{column} GLOB ?", (pattern,)
+    elif prefix:
+        where, parameters = f"{column} >= ? AND {column} < ?", (prefix, prefix + '\U0010ffff')
+    else:
+        where, parameters = "1", ()
+    candidates = query(db_filename,
+                       f"SELECT {COLUMNS} FROM publication "
+                       f"WHERE {where} ORDER BY key", parameters)
+    match = re.compile(fnmatch.translate(pattern)).match
+    if column == 'key_folded':
+        return {key: pub for key, pub in candidates.items()
+                if match(booky.publication.fold(key))}
+    return {key: pub for key, pub in candidates.items()
+            if match(booky.publication.fold(pub.title))}
+
+
+def search_keys(db_filename, search_arg):
+    return search(db_filename, 'key_folded', search_arg)
+
+
+def search_titles(db_filename, search_arg):
+    return search(db_filename, 'title_folded', search_arg)
+
+
+def write_pubdb(db_filename, pubdb_dict):
+    """Write pubdb_dict as a new database at db_filename. The database is
+    built next to it and then moved into place, so readers see either the
+    old database or the new one."""
+    import sqlite3
+    fold = booky.publication.fold
+    temp_filename = f"{db_filename}.{os.getpid()}.tmp"
+    if os.path.exists(temp_filename):
+        os.remove(temp_filename)
+    connection = sqlite3.connect(temp_filename)
+    try:
+        with connection:
+            connection.executescript(SCHEMA)
+            connection.executemany(
+                f"INSERT INTO publication ({COLUMNS}, key_folded, title_folded) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((key, *pub, fold(key), fold(pub.title)) for key, pub in pubdb_dict.items()))
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        connection.close()
+        os.replace(temp_filename, db_filename)
+    except BaseException:
+        connection.close()
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    logger.info(f'{len(pubdb_dict)} publications written to {db_filename}.')
@@ -0,0 +1,215 @@
+### server.py
+
+
+import os
+import json
+import socket
+import logging
+
+
+logger = logging.getLogger('booky')
+
+# The daemon serves the project in its working directory, and a client
+# only talks to a daemon started in its own working directory, so that
+# relative filenames (configure.toml, booklets) mean the same to both.
+SOCKET_FILENAME = ".booky.sock"
+
+# Commands that only read and print. --make-booklet runs pdflatex and
+# writes files, so it stays in the client.
+FORWARDED_COMMANDS = ['config', 'list', 'list_full', 'check_key',
+                      'search_keys', 'search_titles', 'find_duplicates',
+                      'preview_booklet']
+
+
+def is_forwarded(args):
+    """True if args is a command the daemon answers."""
+    return not args.profile and any(getattr(args, c) for c in FORWARDED_COMMANDS)
+
+
+def can_forward(args):
+    return (hasattr(socket, 'AF_UNIX')
+            and os.path.exists(SOCKET_FILENAME)
+            and is_forwarded(args))
+
+
+def send_message(f, message):
+    f.write(json.dumps(message).encode('utf-8') + b'\n')
+    f.flush()
+
+
+def receive_message(f):
+    line = f.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def terminal_description():
+    """What the client's terminal can do, so that the daemon can render
+    rich output for it."""
+    try:
+        width = os.get_terminal_size().columns
+    except OSError:
+        width = None
+    return {'terminal': os.isatty(1),
+            'width': width,
+            'term': os.environ.get('TERM', ''),
+            'colorterm': os.environ.get('COLORTERM', '')}
+
+
+def forward(argv):
+    """Have the daemon run argv. Prints the output and returns the exit
+    status, or None if no daemon answered (then run the command here)."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(SOCKET_FILENAME)
+            with sock.makefile('rwb') as f:
+                send_message(f, {'argv': argv, 'terminal': terminal_description()})
+                response = receive_message(f)
+    except (OSError, ValueError):
+        return None
+    if response is None:
+        return None
+    os.write(1, response['output'].encode('utf-8'))
+    return response['status']
+
+
+def console_options(terminal):
+    if not terminal['terminal']:
+        return {'force_terminal': False, 'width': terminal['width'] or 80}
+    if terminal['colorterm'] in ('truecolor', '24bit'):
+        color_system = 'truecolor'
+    elif '256' in terminal['term']:
+        color_system = '256'
+    else:
+        color_system = 'standard'
+    return {'force_terminal': True,
+            'color_system': color_system,
+            'width': terminal['width'] or 80}
+
+
+def request_error(request):
+    """What is wrong with a request, or None if it is what forward sends.
+    Anything can connect to the socket, so nothing is taken on trust."""
+    if not isinstance(request, dict):
+        return "a request is a JSON object."
+    argv = request.get('argv')
+    if not (isinstance(argv, list) and all(isinstance(arg, str) for arg in argv)):
+        return "argv should be a list of strings."
+    terminal = request.get('terminal')
+    if not (isinstance(terminal, dict)
+            and isinstance(terminal.get('terminal'), bool)
+            and (terminal.get('width') is None
+                 or type(terminal.get('width')) is int and terminal['width'] > 0)
+            and isinstance(terminal.get('term'), str)
+            and isinstance(terminal.get('colorterm'), str)):
+        return "terminal should describe the terminal as terminal_description does."
+    return None
+
+
+def refuse_request(message):
+    """The answer to a request the daemon doesn't run."""
+    import io
+    import contextlib
+    import booky.messages
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        booky.messages.display_error(message)
+    return {'output': output.getvalue(), 'status': 2}
+
+
+def handle_request(request):
+    """Run one forwarded command line and capture what it prints."""
+    import io
+    import contextlib
+    import booky.commands
+    import booky.messages
+
+    error = request_error(request)
+    if error is not None:
+        return refuse_request(f"Bad request to the Booky daemon: {error}")
+    parser = booky.commands.make_parser()
+    output = io.StringIO()
+    status = 0
+    booky.messages.console_options = console_options(request['terminal'])
+    try:
+        # argparse reports a bad command line on stderr.
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            args = parser.parse_args(request['argv'])
+            # Anything can connect to the socket: don't write files,
+            # edit the database or block the daemon for it.
+            if not is_forwarded(args):
+                booky.messages.display_error("The Booky daemon only answers "
+                                             "read-only commands.")
+                return {'output': output.getvalue(), 'status': 2}
+            if not args.format:
+                booky.messages.display_welcome(booky.commands.version)
+            booky.commands.run(parser, args)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    finally:
+        booky.messages.console_options = {}
+    return {'output': output.getvalue(), 'status': status}
+
+
+def remove_stale_socket():
+    """Remove a socket file left behind by a daemon that died. Exit if a
+    daemon is still answering on it."""
+    if not os.path.exists(SOCKET_FILENAME):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(SOCKET_FILENAME)
+        except OSError:
+            os.remove(SOCKET_FILENAME)
+            return
+    import booky.messages
+    booky.messages.display_error(f"A Booky daemon is already running here ({SOCKET_FILENAME}).")
+    exit(1)
+
+
+def serve():
+    """Serve forwarded commands until interrupted. Config, pubdb and the
+    search index are kept in memory and reloaded when their files change.
+    Requests are handled one at a time."""
+    import signal
+    import socketserver
+    import booky.commands
+    import booky.messages
+
+    if not hasattr(socket, 'AF_UNIX'):
+        booky.messages.display_error("The Booky daemon needs Unix domain sockets.")
+        exit(1)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = receive_message(self.rfile)
+            except ValueError as e:
+                send_message(self.wfile, refuse_request(
+                    f"Bad request to the Booky daemon: not JSON ({e})."))
+                return
+            if request is None:
+                return
+            send_message(self.wfile, handle_request(request))
+
+    remove_stale_socket()
+    booky.commands.resident = {}
+    # Load everything once up front so the first request is fast too.
+    cd, pdb = booky.commands.get_pubdb()
+    booky.commands.get_search_index(cd, pdb)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+
+    with socketserver.UnixStreamServer(SOCKET_FILENAME, Handler) as server:
+        booky.messages.display_info(f"Booky daemon listening on {SOCKET_FILENAME}.\n"
+                                    "Stop it with Ctrl-C.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(SOCKET_FILENAME)
@@ -0,0 +1,81 @@
+### snapshot.py
+
+
+import logging
+import os
+import os.path
+import hashlib
+import marshal
+
+
+logger = logging.getLogger('booky')
+
+# Version of the snapshot layout. Bump it whenever the payload changes
+# so that old snapshots are rebuilt instead of misread.
+SNAPSHOT_VERSION = 2
+
+
+def snapshot_filename(source_filename, suffix='snap'):
+    """Sidecar file next to the source file: pubs.toml -> .pubs.toml.snap"""
+    head, tail = os.path.split(source_filename)
+    return os.path.join(head, f".{tail}.{suffix}")
+
+
+def source_signature(source_filename):
+    """Cheap signature of the source file: (mtime in ns, size in bytes)."""
+    st = os.stat(source_filename)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def source_hash(source_bytes):
+    return hashlib.blake2b(source_bytes, digest_size=16).hexdigest()
+
+
+def read_snapshot(source_filename, suffix='snap'):
+    """Return the payload of a snapshot that is still valid for
+    source_filename, or None. The mtime/size signature is checked first;
+    if only the mtime moved (file touched or saved unchanged) the content
+    hash decides, and a matching snapshot gets its signature refreshed."""
+    snap_filename = snapshot_filename(source_filename, suffix)
+    try:
+        with open(snap_filename, 'rb') as f:
+            snapshot = marshal.load(f)
+        signature = source_signature(source_filename)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    if tuple(snapshot['signature']) == signature:
+        return snapshot['payload']
+    if snapshot['signature'][1] != signature[1]:
+        return None
+    try:
+        with open(source_filename, 'rb') as f:
+            if source_hash(f.read()) != snapshot['hash']:
+                return None
+    except OSError:
+        return None
+    write_snapshot(source_filename, signature, snapshot['hash'],
+                   snapshot['payload'], suffix)
+    return snapshot['payload']
+
+
+def write_snapshot(source_filename, signature, hash_value, payload, suffix='snap'):
+    """Write the snapshot atomically. Failure to write (read-only
+    directory, full disk) is not an error: we just parse next time."""
+    snap_filename = snapshot_filename(source_filename, suffix)
+    tmp_filename = f"{snap_filename}.{os.getpid()}.tmp"
+    snapshot = {'version': SNAPSHOT_VERSION,
+                'signature': signature,
+                'hash': hash_value,
+                'payload': payload}
+    try:
+        with open(tmp_filename, 'wb') as f:
+            marshal.dump(snapshot, f)
+        os.replace(tmp_filename, snap_filename)
+    except OSError as e:
+        logger.info(f'could not write snapshot {snap_filename}: {e}')
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
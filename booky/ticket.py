@@ -1,15 +1,21 @@
 ### ticket.py
 
+import array
+import functools
 import logging
 import fnmatch
 import tomllib
-import rich.table, rich.console
+import rich.table
 import booky.messages
+import booky.fragments
+import booky.model
+import booky.timing
+import booky.validation
 
 logger = logging.getLogger('booky')
-logging.basicConfig(level=logging.DEBUG)
 
 
+@booky.timing.timed('load booklet')
 def load_booklet(booklet_filename):
     """Load booklet toml into booklet_dict and verify it."""
     
@@ -17,7 +23,7 @@ def load_booklet(booklet_filename):
         with open(booklet_filename, 'rb') as f:
             booklet_dict = tomllib.load(f)
     except tomllib.TOMLDecodeError: 
-        booky.messages.display_toml_error(config_filename)
+        booky.messages.display_toml_error(booklet_filename)
         exit(1)
     except FileNotFoundError as f:
         booky.messages.display_error(str(f))
@@ -25,20 +31,12 @@ def load_booklet(booklet_filename):
 
     logger.info('booklet_dict loaded.')
 
-    # Verify that the config_dict keys are what we expect.
-    
-    try:
+    # Verify the booklet, reporting every problem at once. Publication
+    # keys are checked against the pubdb by the commands that use it.
 
-        # To do: type and value checks for booklet data.
-        
-        pass
-    
-    except KeyError as v: 
-        booky.messages.display_error(v)
-        exit(1)
-    except ValueError as v:
-        booky.messages.display_error(v)
-        exit(1)
+    booky.validation.exit_on_errors(
+        booky.validation.validate_booklet(booklet_filename, booklet_dict))
+    booklet_dict = booky.model.booklet_from_toml(booklet_dict)
 
     return booklet_dict
 
@@ -54,45 +52,123 @@ def preview_booklet(booklet_filename, pubdb_dict, booklet_dict):
     for n,page in enumerate(booklet_dict['booklet']['pages']):
         for m,t in enumerate(page):
             label = str(n+1) if m==0 else ''
-            pub_key = booklet_dict['ticket'][t]['pub-key']
-            volumes = booklet_dict['ticket'][t]['volumes']
-            table.add_row(label, pubdb_dict[pub_key]['title'], str(volumes))
+            ticket = booklet_dict['ticket'][t]
+            volumes = [list(vol) for vol in ticket.volumes]
+            table.add_row(label, pubdb_dict[ticket.pub_key].title, str(volumes))
         table.add_row()
 
-    console = rich.console.Console()
+    console = booky.messages.make_console()
     print()
     console.print(table)
     print()
 
     
+# Ticket dimensions.
+#
+# Every volume gets eight dimensions computed from the cover size of its
+# publication and its thickness. compute_ticket_parameters does it one
+# ticket at a time. compute_volume_columns does it for any number of
+# volumes at once, column by column: each publication is looked up only
+# once and every dimension is one pass over flat arrays. augment_booklet
+# uses the columns and only then makes the per-ticket dicts that the
+# LaTeX writer wants.
+
+VOLUME_DIMENSIONS = ['cardboard-height', 'cardboard-width',
+                     'paper-height', 'paper-width',
+                     'buckram-height', 'buckram-width',
+                     'backcard-height', 'backcard-width']
+
+
+def compute_ticket_parameters(pubdb_dict, ticket_dict):
+    pub = pubdb_dict[ticket_dict.pub_key]
+    cover_height = pub.cover_height
+    cover_width = pub.cover_width
+    return booky.model.TicketDimensions(
+        ticket_dict.pub_key, pub.title, pub.color,
+        tuple(booky.model.VolumeDimensions(vol.volume_label,
+                                           cover_height,
+                                           cover_width,
+                                           cover_height + 30,
+                                           vol.thickness + 50 + 2*cover_width,
+                                           cover_height + 40,
+                                           vol.thickness + 100,
+                                           cover_height,
+                                           vol.thickness)
+              for vol in ticket_dict.volumes))
+
+
+def make_column(values):
+    """A compact array of machine integers. Dimensions and thicknesses are
+    whole millimetres: validate_volumes and the publication schema only
+    accept integers."""
+    return array.array('q', values)
+
+
+def compute_volume_columns(pubdb_dict, pub_keys, thicknesses):
+    """The dimensions of many volumes at once. pub_keys and thicknesses
+    are parallel sequences, one entry per volume. Returns a dict of
+    columns, one per name in VOLUME_DIMENSIONS, in the same order."""
+    covers = {key: (pubdb_dict[key].cover_height, pubdb_dict[key].cover_width)
+              for key in set(pub_keys)}
+    cover_height = make_column([covers[key][0] for key in pub_keys])
+    cover_width = make_column([covers[key][1] for key in pub_keys])
+    thickness = make_column(thicknesses)
+    return {'cardboard-height': cover_height,
+            'cardboard-width': cover_width,
+            'paper-height': make_column([h + 30 for h in cover_height]),
+            'paper-width': make_column([t + 50 + 2*w for t, w in zip(thickness, cover_width)]),
+            'buckram-height': make_column([h + 40 for h in cover_height]),
+            'buckram-width': make_column([t + 100 for t in thickness]),
+            'backcard-height': cover_height,
+            'backcard-width': thickness}
+
+
+def booklet_volume_columns(pubdb_dict, booklet_dict):
+    """All the volumes of a booklet, page by page and ticket by ticket, as
+    columns: 'ticket' (ticket name), 'pub-key', 'volume-label',
+    'thickness' and the VOLUME_DIMENSIONS."""
+    tickets = booklet_dict['ticket']
+    ticket_names = []
+    pub_keys = []
+    labels = []
+    thicknesses = []
+    for page in booklet_dict['booklet']['pages']:
+        for tt in page:
+            key = tickets[tt].pub_key
+            for vol in tickets[tt].volumes:
+                ticket_names.append(tt)
+                pub_keys.append(key)
+                labels.append(vol.volume_label)
+                thicknesses.append(vol.thickness)
+    columns = compute_volume_columns(pubdb_dict, pub_keys, thicknesses)
+    columns['ticket'] = ticket_names
+    columns['pub-key'] = pub_keys
+    columns['volume-label'] = labels
+    columns['thickness'] = columns['backcard-width']
+    return columns
+
+
+@booky.timing.timed('augment booklet')
 def augment_booklet(config_dict, pubdb_dict, booklet_dict, output_filename):
     """Creates a dictionary containing the complete data needed to typeset
     a booklet of tickets. The ticket parameters are computed here."""
 
-    def compute_ticket_parameters(ticket_dict):
-        key = ticket_dict['pub-key']
-        cover_height = pubdb_dict[key]['cover-height']
-        cover_width = pubdb_dict[key]['cover-width']
-        result = {'pub-key': key,
-                  'title': pubdb_dict[key]['title'],
-                  'color': pubdb_dict[key]['color'],
-                  'volumes': [{'volume-label': vol[0],
-                               'cardboard-height': cover_height, 
-                               'cardboard-width': cover_width,
-                               'paper-height': cover_height + 30,
-                               'paper-width': vol[1] + 50 + 2*cover_width,
-                               'buckram-height': cover_height + 40,
-                               'buckram-width': vol[1] + 100,
-                               'backcard-height': cover_height,
-                               'backcard-width': vol[1]}
-                              for vol in ticket_dict['volumes']]}
-        return result
+    columns = booklet_volume_columns(pubdb_dict, booklet_dict)
+    make = booky.model.VolumeDimensions._make
+    volumes = iter([make(row) for row in
+                    zip(columns['volume-label'], *[columns[d] for d in VOLUME_DIMENSIONS])])
+
+    def ticket_parameters(ticket_dict):
+        pub = pubdb_dict[ticket_dict.pub_key]
+        return booky.model.TicketDimensions(
+            ticket_dict.pub_key, pub.title, pub.color,
+            tuple([next(volumes) for vol in ticket_dict.volumes]))
 
     result = {}
     for key in config_dict['ticket-layout'].keys():
         result[key] = config_dict['ticket-layout'][key]
     result['output-filename'] = output_filename
-    result['pages'] = [[compute_ticket_parameters(booklet_dict['ticket'][tt])
+    result['pages'] = [[ticket_parameters(booklet_dict['ticket'][tt])
                         for tt in page] for page in booklet_dict['booklet']['pages']]
     return result
 
@@ -100,7 +176,9 @@ def augment_booklet(config_dict, pubdb_dict, booklet_dict, output_filename):
 # LaTeX components...
 
   
-def latex_begin(augmented_booklet):
+def latex_preamble(augmented_booklet):
+    """Everything before \\begin{document}. It depends only on the
+    ticket-layout, which is what makes it worth precompiling."""
     font_size = augmented_booklet['font-size']
     left_margin = augmented_booklet['left-margin']
     right_margin = augmented_booklet['right-margin']
@@ -113,7 +191,12 @@ def latex_begin(augmented_booklet):
         "\\fixthelayout",
         "\\renewcommand{\\familydefault}{\\sfdefault}",
         "\\usepackage{multirow}",
-        " ",
+        " "])
+
+
+def latex_begin(augmented_booklet):
+    return "\n".join([
+        latex_preamble(augmented_booklet),
         "\\begin{document}",
         " "])
 
@@ -134,15 +217,13 @@ def latex_table_begin(bd, ticket_dict):
     label_width = bd['label-width']
     volume_separation = bd['volume-separation']
     vertical_stretch = bd['vertical-stretch']
-    number_of_volumes = len(ticket_dict['volumes'])
-    columns_spec = f"|c|p{{{label_width}mm}}|"
-    for k in range(number_of_volumes - 1):
-        columns_spec += f"c|c|p{{{volume_separation}mm}}|"
-    columns_spec += "c|c|"
-    result = f"{{\\renewcommand{{\\arraystretch}}{{{vertical_stretch}}}\n"
-    result += f"\\begin{{tabular}}{{{columns_spec}}}\n"
-    result += "\\hline\n"
-    return result
+    number_of_volumes = len(ticket_dict.volumes)
+    columns_spec = "".join([f"|c|p{{{label_width}mm}}|",
+                            f"c|c|p{{{volume_separation}mm}}|" * (number_of_volumes - 1),
+                            "c|c|"])
+    return "".join([f"{{\\renewcommand{{\\arraystretch}}{{{vertical_stretch}}}\n",
+                    f"\\begin{{tabular}}{{{columns_spec}}}\n",
+                    "\\hline\n"])
 
 
 def latex_table_end():
@@ -158,18 +239,14 @@ def latex_multirow_spec(augmented_booklet, ticket_dict):
     """
     title_width = augmented_booklet['title-width']
     title_styling = augmented_booklet['title-styling']
-    title = ticket_dict['title']
-    color = ticket_dict['color']
-    number_of_volumes = len(ticket_dict['volumes'])
-    
-    result = f"\\multirow{{6}}{{{title_width}mm}}{{{title_styling} {title}}}"
-    result += f" & \\multirow{{2}}{{*}}{{\\Large {color}}} &"
-    for k,vol in enumerate(ticket_dict['volumes']):
-        result += f"\\multicolumn{{2}}{{c|}}{{{vol['volume-label']}}}"
-        if k != number_of_volumes - 1:
-            result += " & & "
-    result += " \\\\\n"
-    return result
+    title = ticket_dict.title
+    color = ticket_dict.color
+    labels = " & & ".join([f"\\multicolumn{{2}}{{c|}}{{{vol.volume_label}}}"
+                           for vol in ticket_dict.volumes])
+    return "".join([f"\\multirow{{6}}{{{title_width}mm}}{{{title_styling} {title}}}",
+                    f" & \\multirow{{2}}{{*}}{{\\Large {color}}} &",
+                    labels,
+                    " \\\\\n"])
 
 
 def latex_header_cline(ticket_dict):
@@ -181,12 +258,9 @@ def latex_header_cline(ticket_dict):
     \cline{3-4}\cline{6-7}\cline{9-10}\cline{12-13}
 
     """
-    number_of_volumes = len(ticket_dict['volumes'])
-    result = ""
-    for k in range(number_of_volumes):
-        result += f"\\cline{{{3*(k + 1)}-{3*(k + 1) + 1}}}"
-    result += "\n"
-    return result
+    number_of_volumes = len(ticket_dict.volumes)
+    return "".join([f"\\cline{{{3*(k + 1)}-{3*(k + 1) + 1}}}"
+                    for k in range(number_of_volumes)]) + "\n"
 
 
 def latex_header_HW(ticket_dict):
@@ -196,12 +270,8 @@ def latex_header_HW(ticket_dict):
     & & H & W & & H & W & & H & W & & H & W\\
         
     """
-    number_of_volumes = len(ticket_dict['volumes'])
-    result = ""
-    for k in range(number_of_volumes):
-        result += " & & H & W"
-    result += "\\\\\n"
-    return result
+    number_of_volumes = len(ticket_dict.volumes)
+    return " & & H & W" * number_of_volumes + "\\\\\n"
 
 
 def latex_body_cline(ticket_dict):
@@ -211,12 +281,17 @@ def latex_body_cline(ticket_dict):
     \cline{2-2}\cline{3-4}\cline{6-7}\cline{9-10}\cline{12-13}
 
     """
-    number_of_volumes = len(ticket_dict['volumes'])
-    result = "\\cline{2-2}"
-    for k in range(number_of_volumes):
-        result += f"\\cline{{{3*(k+1)}-{3*(k+1)+1}}}"
-    result += "\n"
-    return result
+    number_of_volumes = len(ticket_dict.volumes)
+    return "\\cline{2-2}" + "".join([f"\\cline{{{3*(k+1)}-{3*(k+1)+1}}}"
+                                     for k in range(number_of_volumes)]) + "\n"
+
+
+def latex_dimension_row(label, height_field, width_field, ticket_dict):
+    """The four dimension rows below differ only in their label and in
+    which volume dimensions they show."""
+    cells = " & & ".join([f"{getattr(vol, height_field)} & {getattr(vol, width_field)}"
+                          for vol in ticket_dict.volumes])
+    return f"& {label} & {cells} \\\\\n"
 
 
 def latex_cardboard_row(augmented_booklet, ticket_dict):
@@ -227,14 +302,8 @@ def latex_cardboard_row(augmented_booklet, ticket_dict):
     Here we have a user-set french label (carton) for the cardboard row label.
     
     """
-    cardboard_label = augmented_booklet['cardboard-label']
-    result = f"& {cardboard_label}"
-    for k,vol in enumerate(ticket_dict['volumes']):
-        result += f" & {vol['cardboard-height']} & {vol['cardboard-width']} &"
-    # Strip off the last &
-    result = result[0:-1]
-    result += "\\\\\n"
-    return result
+    return latex_dimension_row(augmented_booklet['cardboard-label'],
+                               'cardboard_height', 'cardboard_width', ticket_dict)
                 
 
 def latex_paper_row(augmented_booklet, ticket_dict):
@@ -246,14 +315,8 @@ def latex_paper_row(augmented_booklet, ticket_dict):
     All these data rows are very similar.
 
     """
-    paper_label = augmented_booklet['paper-label']
-    result = f"& {paper_label}"
-    for k,vol in enumerate(ticket_dict['volumes']):
-        result += f" & {vol['paper-height']} & {vol['paper-width']} &"
-    # Strip off the last &
-    result = result[0:-1]
-    result += "\\\\\n"
-    return result
+    return latex_dimension_row(augmented_booklet['paper-label'],
+                               'paper_height', 'paper_width', ticket_dict)
 
 
 def latex_buckram_row(augmented_booklet, ticket_dict):
@@ -262,14 +325,8 @@ def latex_buckram_row(augmented_booklet, ticket_dict):
     & buckram  & 281 & 140 & & 281 & 140 & & 281 & 134 & & 281 & 141 \\
         
     """
-    buckram_label = augmented_booklet['buckram-label']
-    result = f"& {buckram_label}"
-    for k,vol in enumerate(ticket_dict['volumes']):
-        result += f" & {vol['buckram-height']} & {vol['buckram-width']} &"
-    # Strip off the last &
-    result = result[0:-1]
-    result += "\\\\\n"
-    return result
+    return latex_dimension_row(augmented_booklet['buckram-label'],
+                               'buckram_height', 'buckram_width', ticket_dict)
 
 
 def latex_backcard_row(augmented_booklet, ticket_dict):
@@ -280,14 +337,8 @@ def latex_backcard_row(augmented_booklet, ticket_dict):
     Here the user has supplied his own label "carte-a-dos" for the backcard.
 
     """
-    backcard_label = augmented_booklet['backcard-label']
-    result = f"& {backcard_label}"
-    for k,vol in enumerate(ticket_dict['volumes']):
-        result += f" & {vol['backcard-height']} & {vol['backcard-width']} &"
-    # Strip off the last &
-    result = result[0:-1]
-    result += "\\\\\n"
-    return result
+    return latex_dimension_row(augmented_booklet['backcard-label'],
+                               'backcard_height', 'backcard_width', ticket_dict)
 
 
 def latex_between_tickets(augmented_booklet):
@@ -299,26 +350,87 @@ def latex_between_pages():
     return "\n\\vfill\\newpage\n"
 
 
+def latex_ticket_fragments(augmented_booklet, my_ticket):
+    yield latex_table_begin(augmented_booklet, my_ticket)
+    yield latex_multirow_spec(augmented_booklet, my_ticket)
+    yield latex_header_cline(my_ticket)
+    yield latex_header_HW(my_ticket)
+    body_cline = latex_body_cline(my_ticket)
+    yield latex_cardboard_row(augmented_booklet, my_ticket)
+    yield body_cline
+    yield latex_paper_row(augmented_booklet, my_ticket)
+    yield body_cline
+    yield latex_buckram_row(augmented_booklet, my_ticket)
+    yield body_cline
+    yield latex_backcard_row(augmented_booklet, my_ticket)
+    yield body_cline
+    yield latex_table_end()
+
+
+# Ticket templates.
+#
+# Apart from the title, colour, volume labels and dimensions, the table
+# of a ticket depends only on its number of volumes and the layout. So
+# for each (layout, number of volumes) the functions above are run once
+# on a ticket whose fields are placeholders, and what they write becomes
+# a str.format template: the static skeleton with its braces doubled,
+# and a positional field where each placeholder was, {0} the title, {1}
+# the colour and then the fields of each volume in turn. A ticket is
+# then one format call, and the output is exactly that of
+# latex_ticket_fragments.
+
+PLACEHOLDER = "\0"
+
+
+@functools.lru_cache(maxsize=256)
+def compile_ticket_template(layout, number_of_volumes):
+    """The template for tickets of number_of_volumes volumes. layout is a
+    tuple of (ticket-layout name, value) pairs."""
+    number_of_fields = len(booky.model.VolumeDimensions._fields)
+    slot = lambda n: f"{PLACEHOLDER}{n}{PLACEHOLDER}"
+    volumes = tuple([booky.model.VolumeDimensions._make(
+                         [slot(2 + k*number_of_fields + j) for j in range(number_of_fields)])
+                     for k in range(number_of_volumes)])
+    my_ticket = booky.model.TicketDimensions('', slot(0), slot(1), volumes)
+    parts = "".join(latex_ticket_fragments(dict(layout), my_ticket)).split(PLACEHOLDER)
+    # Even parts are static text, odd parts field numbers.
+    return "".join([part.replace('{', '{{').replace('}', '}}') if k % 2 == 0
+                    else f"{{{part}}}"
+                    for k, part in enumerate(parts)])
+
+
+def latex_ticket(layout, my_ticket):
+    """The LaTeX of my_ticket as one string, from its template."""
+    template = compile_ticket_template(layout, len(my_ticket.volumes))
+    return template.format(my_ticket.title, my_ticket.color,
+                           *[value for vol in my_ticket.volumes for value in vol])
+
+
+def latex_fragments(augmented_booklet, first_page=1, ticket_latex=None):
+    """The whole LaTeX document, one fragment at a time, so that it can be
+    written or piped without ever being held in memory. first_page is for
+    documents that hold only part of a booklet's pages. ticket_latex
+    returns the LaTeX of a ticket as one string; by default it comes from
+    the cache in booky.fragments."""
+    if ticket_latex is None:
+        ticket_latex = booky.fragments.ticket_latex_function(augmented_booklet)
+    yield latex_begin(augmented_booklet)
+    if first_page != 1:
+        yield f"\\setcounter{{page}}{{{first_page}}}\n"
+    between_tickets = latex_between_tickets(augmented_booklet)
+    span = booky.timing.span
+    for page in augmented_booklet['pages']:
+        for my_ticket in page:
+            # The span also takes in whatever the consumer does with the
+            # fragments of the ticket, such as writing them out.
+            with span('latex ticket', 'latex', my_ticket.pub_key):
+                yield ticket_latex(my_ticket)
+            yield between_tickets
+        yield latex_between_pages()
+    yield latex_end()
+
+
+@booky.timing.timed('write latex')
 def latex_write(augmented_booklet):
-    # my_ticket = augmented_booklet['pages'][0][4]
     with open(augmented_booklet['output-filename'], 'w') as f:
-        f.write(latex_begin(augmented_booklet))
-        for page in augmented_booklet['pages']:
-            for my_ticket in page:
-                f.write(latex_table_begin(augmented_booklet, my_ticket))
-                f.write(latex_multirow_spec(augmented_booklet, my_ticket))
-                f.write(latex_header_cline(my_ticket))
-                f.write(latex_header_HW(my_ticket))
-                f.write(latex_cardboard_row(augmented_booklet, my_ticket))
-                f.write(latex_body_cline(my_ticket))
-                f.write(latex_paper_row(augmented_booklet, my_ticket))
-                f.write(latex_body_cline(my_ticket))
-                f.write(latex_buckram_row(augmented_booklet, my_ticket))
-                f.write(latex_body_cline(my_ticket))
-                f.write(latex_backcard_row(augmented_booklet, my_ticket))
-                f.write(latex_body_cline(my_ticket))
-                f.write(latex_table_end())
-                f.write(latex_between_tickets(augmented_booklet))
-            f.write(latex_between_pages())
-        f.write(latex_end())
-
+        f.writelines(latex_fragments(augmented_booklet))
@@ -0,0 +1,120 @@
+### timing.py
+#
+# Phase timing for --profile.
+#
+# Loading, augmentation, LaTeX output and pdflatex runs are wrapped in
+# named spans, either with the timed decorator or with a span() block.
+# Until enable() is called, span() hands back one shared do-nothing
+# context manager and timed functions make a single extra call, so the
+# instrumentation costs next to nothing. Once enabled, every span is
+# recorded with its thread, and can be written out as a Chrome trace
+# (load it in chrome://tracing or https://ui.perfetto.dev) or shown as
+# a summary table.
+
+
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+import booky.messages
+
+
+# The recorded spans, (name, category, detail, start ns, duration ns,
+# thread), or None while timing is off.
+spans = None
+started = 0
+
+NULL_SPAN = contextlib.nullcontext()
+
+
+def enable():
+    global spans, started
+    spans = []
+    started = time.perf_counter_ns()
+
+
+def disable():
+    global spans
+    spans = None
+
+
+@contextlib.contextmanager
+def recorded_span(name, category, detail):
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        # list.append is atomic, so threads can share the list.
+        spans.append((name, category, detail, start,
+                      time.perf_counter_ns() - start, threading.get_ident()))
+
+
+def span(name, category='booky', detail=None):
+    """A context manager timing its block as name. detail is shown
+    with the span in traces, e.g. the publication of a LaTeX ticket."""
+    if spans is None:
+        return NULL_SPAN
+    return recorded_span(name, category, detail)
+
+
+def timed(name, category='booky'):
+    """Decorator timing every call of a function as name."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if spans is None:
+                return function(*args, **kwargs)
+            with recorded_span(name, category, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def chrome_trace():
+    """The recorded spans in the Chrome trace event format."""
+    pid = os.getpid()
+    events = []
+    for name, category, detail, start, duration, thread in spans or []:
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': thread,
+                 'ts': (start - started) / 1000, 'dur': duration / 1000}
+        if detail is not None:
+            event['args'] = {'detail': detail}
+        events.append(event)
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(trace_filename):
+    with open(trace_filename, 'w') as f:
+        json.dump(chrome_trace(), f)
+
+
+def summary():
+    """{name: (count, total ns, longest ns)} of the recorded spans, in
+    order of first appearance."""
+    result = {}
+    for name, category, detail, start, duration, thread in spans or []:
+        count, total, longest = result.get(name, (0, 0, 0))
+        result[name] = (count + 1, total + duration, max(longest, duration))
+    return result
+
+
+def display_summary(trace_filename=None):
+    import rich.table
+    table = rich.table.Table(title='Profile')
+    table.add_column('Span', style='bold magenta')
+    table.add_column('Calls', justify='right')
+    table.add_column('Total ms', justify='right')
+    table.add_column('Mean ms', justify='right')
+    table.add_column('Max ms', justify='right')
+    items = sorted(summary().items(), key=lambda item: item[1][1], reverse=True)
+    for name, (count, total, longest) in items:
+        table.add_row(name, str(count), f"{total/1e6:.2f}",
+                      f"{total/count/1e6:.3f}", f"{longest/1e6:.2f}")
+    if trace_filename:
+        table.caption = f"Chrome trace written to {trace_filename}"
+    console = booky.messages.make_console()
+    print()
+    console.print(table)
+    print()
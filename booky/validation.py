@@ -0,0 +1,272 @@
+### validation.py
+#
+# Validation of configure.toml, the publication database and booklets.
+#
+# Each table layout below is compiled once (compile_table) into a dict of
+# field types and frozensets of required and allowed field names, so a
+# table is checked with two set operations and one isinstance per field.
+# The checks append messages to a list of errors instead of stopping at
+# the first problem, so a bad file is reported in full. Publications take
+# a fast path: an entry with exactly the expected fields and types costs
+# a handful of comparisons, and only a bad entry is looked at in detail.
+
+
+import booky.messages
+
+
+TYPE_NAMES = {int: 'an integer', (int, float): 'a number', str: 'a string',
+              list: 'a list', dict: 'a dict'}
+
+
+def compile_table(fields, optional=()):
+    """fields and optional are lists of (name, type)."""
+    types = dict(fields)
+    types.update(optional)
+    return {'types': types,
+            'required': frozenset(name for name, _ in fields),
+            'allowed': frozenset(types)}
+
+
+CONFIG = compile_table([('pub-db-filename', str),
+                        ('pub-validation', dict),
+                        ('ticket-layout', dict)],
+                       optional=[('pub-db-backend', str)])
+
+CONFIG_PUB_VALIDATION = compile_table([('colors', list),
+                                       ('block-limits', list),
+                                       ('cover-limits', list)])
+
+CONFIG_TICKET_LAYOUT = compile_table([('left-margin', (int, float)),
+                                      ('right-margin', (int, float)),
+                                      ('upper-margin', (int, float)),
+                                      ('lower-margin', (int, float)),
+                                      ('font-size', int),
+                                      ('vertical-stretch', (int, float)),
+                                      ('title-width', (int, float)),
+                                      ('title-styling', str),
+                                      ('label-width', (int, float)),
+                                      ('volume-separation', (int, float)),
+                                      ('ticket-spacing', (int, float)),
+                                      ('cardboard-label', str),
+                                      ('paper-label', str),
+                                      ('buckram-label', str),
+                                      ('backcard-label', str)])
+
+PUB_DB_BACKENDS = ('toml', 'sqlite')
+
+PUBLICATION = compile_table([('title', str),
+                             ('color', str),
+                             ('block-height', int),
+                             ('block-width', int),
+                             ('cover-height', int),
+                             ('cover-width', int)])
+
+BOOKLET = compile_table([('ticket', dict),
+                         ('booklet', dict)])
+
+# Without pages, the tickets are packed onto pages automatically.
+BOOKLET_BOOKLET = compile_table([],
+                                optional=[('pages', list), ('filename', str)])
+
+TICKET = compile_table([('pub-key', str),
+                        ('volumes', list)])
+
+
+def has_type(value, value_type):
+    # TOML booleans are not numbers.
+    return isinstance(value, value_type) and not isinstance(value, bool)
+
+
+def check_table(table, schema, where, errors):
+    """Check the fields of table against a compiled schema. Returns true
+    if the table can be looked at further."""
+    if not isinstance(table, dict):
+        errors.append(f"{where} should be a table.")
+        return False
+    fields = table.keys()
+    for name in sorted(fields - schema['allowed']):
+        errors.append(f"{where}: unexpected key {name}.")
+    for name in sorted(schema['required'] - fields):
+        errors.append(f"{where}: missing key {name}.")
+    types = schema['types']
+    for name in fields & schema['allowed']:
+        value = table[name]
+        if not has_type(value, types[name]):
+            errors.append(f"{where}: {name} value {value!r} should be "
+                          f"{TYPE_NAMES[types[name]]}.")
+    return True
+
+
+def is_limits(x):
+    return (isinstance(x, list) and len(x) == 2
+            and has_type(x[0], int) and has_type(x[1], int) and x[0] <= x[1])
+
+
+def validate_config(config_filename, config_dict):
+    """Errors in config_dict, a list of messages."""
+    errors = []
+    check_table(config_dict, CONFIG, config_filename, errors)
+
+    backend = config_dict.get('pub-db-backend')
+    if isinstance(backend, str) and backend not in PUB_DB_BACKENDS:
+        errors.append(f"{config_filename}: pub-db-backend should be one of "
+                      f"{', '.join(PUB_DB_BACKENDS)}.")
+
+    pv = config_dict.get('pub-validation')
+    if isinstance(pv, dict):
+        check_table(pv, CONFIG_PUB_VALIDATION, f"{config_filename} pub-validation", errors)
+        colors = pv.get('colors')
+        if isinstance(colors, list):
+            for c in colors:
+                if not (isinstance(c, str) and len(c) == 3):
+                    errors.append(f"{config_filename}: color {c!r} should be "
+                                  "a string of length 3.")
+        for name in ('block-limits', 'cover-limits'):
+            if isinstance(pv.get(name), list) and not is_limits(pv[name]):
+                errors.append(f"{config_filename}: bad {name} {pv[name]}, "
+                              "should be [smallest, largest].")
+
+    tl = config_dict.get('ticket-layout')
+    if isinstance(tl, dict):
+        check_table(tl, CONFIG_TICKET_LAYOUT, f"{config_filename} ticket-layout", errors)
+    return errors
+
+
+def pub_rules(config_dict):
+    """The pub-validation settings of a verified config_dict, compiled."""
+    pv = config_dict['pub-validation']
+    return {'colors': frozenset(pv['colors']),
+            'block-limits': tuple(pv['block-limits']),
+            'cover-limits': tuple(pv['cover-limits'])}
+
+
+def validate_publication_entry(key, entry, where, errors):
+    """Check one raw pubdb TOML table. Returns true if it is well formed."""
+    if (type(entry) is dict and entry.keys() == PUBLICATION['allowed']
+            and type(entry['title']) is str and type(entry['color']) is str
+            and type(entry['block-height']) is int and type(entry['block-width']) is int
+            and type(entry['cover-height']) is int and type(entry['cover-width']) is int):
+        return True
+    before = len(errors)
+    check_table(entry, PUBLICATION, f"{where} [{key}]", errors)
+    return len(errors) == before
+
+
+def validate_pubdb_entries(pubdb_filename, toml_dict):
+    """Errors in the tables of a pubdb TOML file, a list of messages."""
+    errors = []
+    for key, entry in toml_dict.items():
+        validate_publication_entry(key, entry, pubdb_filename, errors)
+    return errors
+
+
+def validate_publications(where, pubdb_dict, rules):
+    """Errors of the publications of pubdb_dict against the pub-validation
+    rules (see pub_rules), a list of messages."""
+    errors = []
+    colors = rules['colors']
+    block_lo, block_hi = rules['block-limits']
+    cover_lo, cover_hi = rules['cover-limits']
+    for key, pub in pubdb_dict.items():
+        if pub.color not in colors:
+            errors.append(f"{where} [{key}]: color {pub.color!r} is not in pub-validation colors.")
+        if not (block_lo <= pub.block_height <= block_hi
+                and block_lo <= pub.block_width <= block_hi):
+            errors.append(f"{where} [{key}]: block {pub.block_height}x{pub.block_width} "
+                          f"is outside block-limits [{block_lo}, {block_hi}].")
+        if not (cover_lo <= pub.cover_height <= cover_hi
+                and cover_lo <= pub.cover_width <= cover_hi):
+            errors.append(f"{where} [{key}]: cover {pub.cover_height}x{pub.cover_width} "
+                          f"is outside cover-limits [{cover_lo}, {cover_hi}].")
+    return errors
+
+
+def validate_volumes(volumes, where, errors):
+    for n, vol in enumerate(volumes, 1):
+        if not (isinstance(vol, list) and len(vol) == 2
+                and isinstance(vol[0], str) and has_type(vol[1], int)):
+            errors.append(f"{where}: volume {n} {vol!r} should be "
+                          "[\"label\", thickness].")
+        elif vol[1] <= 0:
+            errors.append(f"{where}: volume {vol[0]} has thickness {vol[1]}.")
+    if not volumes:
+        errors.append(f"{where}: no volumes.")
+
+
+def validate_booklet(booklet_filename, booklet_dict):
+    """Errors in a booklet TOML, a list of messages. Publication keys are
+    checked separately, see validate_references."""
+    errors = []
+    if not check_table(booklet_dict, BOOKLET, booklet_filename, errors):
+        return errors
+
+    tickets = booklet_dict.get('ticket')
+    if isinstance(tickets, dict):
+        for name, ticket in tickets.items():
+            where = f"{booklet_filename} [ticket.{name}]"
+            if check_table(ticket, TICKET, where, errors) and isinstance(ticket.get('volumes'), list):
+                validate_volumes(ticket['volumes'], where, errors)
+    else:
+        tickets = {}
+
+    booklet = booklet_dict.get('booklet')
+    if isinstance(booklet, dict):
+        where = f"{booklet_filename} [booklet]"
+        check_table(booklet, BOOKLET_BOOKLET, where, errors)
+        pages = booklet.get('pages')
+        if isinstance(pages, list):
+            for n, page in enumerate(pages, 1):
+                if not isinstance(page, list):
+                    errors.append(f"{where}: page {n} should be a list of ticket names.")
+                    continue
+                for t in page:
+                    if t not in tickets:
+                        errors.append(f"{where}: page {n} uses unknown ticket {t!r}.")
+    return errors
+
+
+def validate_references(booklet_filename, booklet_dict, pubdb_dict):
+    """Errors for tickets whose pub-key is not in pubdb_dict, a list of
+    messages. booklet_dict is loaded or raw TOML; malformed tickets are
+    left to validate_booklet."""
+    errors = []
+    tickets = booklet_dict.get('ticket')
+    if not isinstance(tickets, dict):
+        return errors
+    for name, ticket in tickets.items():
+        try:
+            pub_key = ticket['pub-key']
+        except (KeyError, TypeError):
+            continue
+        if isinstance(pub_key, str) and pub_key not in pubdb_dict:
+            errors.append(f"{booklet_filename} [ticket.{name}]: "
+                          f"no publication with key {pub_key}.")
+    return errors
+
+
+def read_toml(filename, errors):
+    """The parsed TOML file, or None with the problem added to errors."""
+    import tomllib
+    try:
+        with open(filename, 'rb') as f:
+            return tomllib.load(f)
+    except tomllib.TOMLDecodeError as e:
+        errors.append(f"{filename} is not valid TOML: {e}")
+    except OSError as e:
+        errors.append(f"cannot read {filename}: {e.strerror}")
+    return None
+
+
+def display_errors(errors, limit=50):
+    """Show all errors (up to limit of them) in one error panel."""
+    import rich.markup
+    shown = [rich.markup.escape(e) for e in errors[:limit]]
+    if len(errors) > limit:
+        shown.append(f"... and {len(errors) - limit} more.")
+    booky.messages.display_error("\n".join(shown))
+
+
+def exit_on_errors(errors):
+    if errors:
+        display_errors(errors)
+        exit(1)
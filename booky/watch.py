@@ -0,0 +1,179 @@
+### watch.py
+#
+# --watch: rebuild a booklet whenever it, configure.toml or the pubdb
+# changes.
+#
+# The files are polled for a new mtime or size. Editors save in bursts
+# (temporary file, rename, touch), so a rebuild waits until the files
+# have been quiet for DEBOUNCE_SECONDS. The previous booklet is kept
+# between rebuilds: a ticket whose table and publication are unchanged
+# keeps its dimensions, and its LaTeX is reused as long as the
+# ticket-layout stays the same. Only new or edited tickets go through
+# compute_ticket_parameters and the LaTeX functions again; moving
+# tickets around the pages costs nothing but the writing of the file.
+
+
+import os
+import glob
+import time
+import pathlib
+import booky.commands
+import booky.fragments
+import booky.journal
+import booky.messages
+import booky.packing
+import booky.publication
+import booky.pubshards
+import booky.snapshot
+import booky.ticket
+import booky.validation
+
+POLL_SECONDS = 0.25
+DEBOUNCE_SECONDS = 0.5
+
+
+def signatures(filenames):
+    result = []
+    for filename in filenames:
+        try:
+            result.append(booky.snapshot.source_signature(filename))
+        except OSError:
+            result.append(None)
+    return tuple(result)
+
+
+def new_state(booklet_filename):
+    # 'dimensions' maps ticket names to (Ticket, Publication,
+    # TicketDimensions) of the previous build, 'latex' the
+    # TicketDimensions of the previous build to their LaTeX.
+    return {'booklet-filename': booklet_filename,
+            'pubdb-filename': None,
+            'layout': None,
+            'dimensions': {},
+            'latex': {}}
+
+
+def watched_files(state):
+    filenames = [state['booklet-filename'], booky.commands.CONFIG_FILENAME]
+    pubdb_filename = state['pubdb-filename']
+    if pubdb_filename and booky.publication.is_sharded(pubdb_filename):
+        filenames.extend(sorted(glob.glob(booky.pubshards.shard_pattern(pubdb_filename))))
+    elif pubdb_filename:
+        filenames.append(pubdb_filename)
+        if os.path.exists(booky.journal.journal_filename(pubdb_filename)):
+            filenames.append(booky.journal.journal_filename(pubdb_filename))
+    return filenames
+
+
+def update_booklet(state, config_dict, pubdb_dict, booklet_dict, output_filename):
+    """The augmented booklet (as augment_booklet makes it), computing
+    only the tickets that changed since the previous call. Returns
+    (augmented_booklet, number of tickets recomputed)."""
+    layout = config_dict['ticket-layout']
+    if layout != state['layout']:
+        state['layout'] = dict(layout)
+        state['latex'] = {}
+
+    previous = state['dimensions']
+    dimensions = {}
+    recomputed = 0
+    for name, ticket in booklet_dict['ticket'].items():
+        pub = pubdb_dict[ticket.pub_key]
+        old = previous.get(name)
+        if old is not None and old[0] == ticket and old[1] == pub:
+            dimensions[name] = old
+        else:
+            dimensions[name] = (ticket, pub,
+                                booky.ticket.compute_ticket_parameters(pubdb_dict, ticket))
+            recomputed += 1
+    state['dimensions'] = dimensions
+
+    result = dict(layout)
+    result['output-filename'] = output_filename
+    result['pages'] = [[dimensions[tt][2] for tt in page]
+                       for page in booklet_dict['booklet']['pages']]
+    used = {td for page in result['pages'] for td in page}
+    state['latex'] = {td: latex for td, latex in state['latex'].items() if td in used}
+    return (result, recomputed)
+
+
+def write_latex(state, augmented_booklet):
+    """Write the .tex file, with the LaTeX of unchanged tickets taken
+    from state. Returns the number of tickets typeset anew."""
+    latex = state['latex']
+    layout = booky.fragments.layout_values(augmented_booklet)
+    typeset = []
+
+    def ticket_latex(my_ticket):
+        result = latex.get(my_ticket)
+        if result is None:
+            result = booky.fragments.ticket_latex(layout, my_ticket)
+            latex[my_ticket] = result
+            typeset.append(my_ticket)
+        return result
+
+    with open(augmented_booklet['output-filename'], 'w') as f:
+        f.writelines(booky.ticket.latex_fragments(augmented_booklet,
+                                                  ticket_latex=ticket_latex))
+    return len(typeset)
+
+
+def rebuild(state, use_format=True):
+    """Bring the .tex and the PDF up to date. Problems with the files
+    are shown and the watch goes on."""
+    import booky.build
+    booklet_filename = state['booklet-filename']
+    stem = pathlib.Path(booklet_filename).stem
+    start = time.perf_counter()
+    console = booky.messages.make_console()
+    try:
+        config_dict = booky.commands.get_config()
+        state['pubdb-filename'] = config_dict['pub-db-filename']
+        booklet_dict = booky.ticket.load_booklet(booklet_filename)
+        cd, pdb = booky.commands.get_publications(
+            ticket.pub_key for ticket in booklet_dict['ticket'].values())
+        booky.validation.exit_on_errors(
+            booky.validation.validate_references(booklet_filename, booklet_dict, pdb))
+        booklet_dict = booky.packing.paginate(config_dict, pdb, booklet_dict)
+        ab, recomputed = update_booklet(state, config_dict, pdb, booklet_dict, stem + '.tex')
+        typeset = write_latex(state, ab)
+    except SystemExit:
+        console.print(f"[yellow]{time.strftime('%H:%M:%S')} {booklet_filename} "
+                      "not rebuilt, waiting for the next change.")
+        return
+
+    format_filename = booky.build.precompiled_format(ab) if use_format else None
+    status = booky.build.run_pdflatex(stem + '.tex', quiet=True,
+                                      format_filename=format_filename)
+    seconds = time.perf_counter() - start
+    tickets = len(booklet_dict['ticket'])
+    if status == 0:
+        console.print(f"[green]{time.strftime('%H:%M:%S')} {stem}.pdf rebuilt in {seconds:.2f}s "
+                      f"({recomputed} of {tickets} tickets recomputed, {typeset} typeset).")
+    else:
+        console.print(f"[red]{time.strftime('%H:%M:%S')} pdflatex failed on {stem}.tex "
+                      f"(exit status {status}), see {stem}.log.")
+
+
+def watch_booklet(booklet_filename, use_format=True):
+    """Rebuild booklet_filename on every change until interrupted."""
+    booky.commands.resident = {}
+    state = new_state(booklet_filename)
+    console = booky.messages.make_console()
+    rebuild(state, use_format)
+    console.print(f"Watching {', '.join(watched_files(state))}. Press Ctrl-C to stop.")
+    seen = signatures(watched_files(state))
+    changed_at = None
+    try:
+        while True:
+            time.sleep(POLL_SECONDS)
+            current = signatures(watched_files(state))
+            if current != seen:
+                seen = current
+                changed_at = time.monotonic()
+            elif changed_at is not None and time.monotonic() - changed_at >= DEBOUNCE_SECONDS:
+                changed_at = None
+                rebuild(state, use_format)
+                seen = signatures(watched_files(state))
+    except KeyboardInterrupt:
+        print()
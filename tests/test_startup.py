@@ -0,0 +1,75 @@
+### test_startup.py
+#
+# Startup budget of the cheap commands: python -X importtime shows what
+# a command imports, and rich, tomllib, sqlite3, the LaTeX machinery and
+# importlib.metadata must stay out of the way of --check-key.
+
+
+import os
+import shutil
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+
+# Modules only the commands that need them may import.
+HEAVY = ('rich', 'tomllib', 'tomli', 'sqlite3', 'importlib.metadata',
+         'concurrent.futures', 'booky.ticket', 'booky.build', 'booky.packing')
+
+# Microseconds for the imports of booky.__main__, leaving room for slow
+# machines: rich alone used to take most of it.
+STARTUP_BUDGET = 250_000
+
+
+def booky(project, *args):
+    """-X importtime of python -m booky args in project: {module:
+    cumulative microseconds}."""
+    env = dict(os.environ, PYTHONPATH=str(REPO))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'booky',
+                              '--no-daemon', *args],
+                             cwd=project, env=env, capture_output=True, text=True)
+    assert process.returncode == 0, process.stdout + process.stderr
+    imported = {}
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative_us, name = line.split('|')
+            imported[name.strip()] = int(cumulative_us)
+    return imported
+
+
+def heavy(modules):
+    return sorted(m for m in modules
+                  if any(m == h or m.startswith(h + '.') for h in HEAVY))
+
+
+@pytest.fixture
+def project(tmp_path):
+    shutil.copytree(REPO / 'sample-project', tmp_path / 'project',
+                    ignore=shutil.ignore_patterns('.*', '*.pdf', '*.tex'))
+    return tmp_path / 'project'
+
+
+def test_startup_imports_nothing_heavy():
+    """Parsing the command line is all booky.__main__ does before the
+    command runs."""
+    env = dict(os.environ, PYTHONPATH=str(REPO))
+    code = ("import sys, booky.commands, booky.messages, booky.server\n"
+            "args = booky.commands.make_parser().parse_args(['-c', 'qq'])\n"
+            "booky.server.can_forward(args)\n"
+            "print(' '.join(sys.modules))\n")
+    process = subprocess.run([sys.executable, '-c', code], env=env,
+                             capture_output=True, text=True, check=True)
+    assert heavy(process.stdout.split()) == []
+
+
+def test_check_key_startup_budget(project):
+    booky(project, '-c', 'qq')    # writes the snapshots and the index
+    imported = booky(project, '-c', 'qq')
+    # rich prints the answer; nothing else heavy is needed for a new key.
+    assert [m for m in heavy(imported) if not m.startswith('rich')] == []
+    startup = sum(imported.get(m, 0) for m in ('booky.commands', 'booky.server'))
+    assert startup < STARTUP_BUDGET